@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+import getpass
+import os
+import sys
+
+from datetime import datetime
+from typing import Optional, Callable, Dict
+
+import click
+import logging
+
+from repronim_timing import (TimeIndex, build_time_index, save_time_index,
+                             get_time_index_path, get_session_id)
+from dump_birch import get_birch_line_isotime
+from dump_psychopy import get_psychopy_line_isotime
+from dump_reproevents import (get_revents_line_isotime_func,
+                              get_revents_dtypes)
+
+
+# initialize the logger
+# Note: all logs goes to stderr, imported dump tools already
+# installed own stderr handlers, so keep only one
+logger = logging.getLogger(__name__)
+logging.getLogger().handlers = [logging.StreamHandler(sys.stderr)]
+logger.setLevel(logging.DEBUG)
+#logger.debug(f"name={__name__}")
+
+
+def index_file(path: str,
+               get_time: Callable[[bytes], Optional[datetime]],
+               step: int, lo: int = 0,
+               dtypes: Optional[Dict[str, str]] = None):
+    index: TimeIndex = build_time_index(path, get_time, step, lo)
+    if dtypes:
+        index.dtypes = dtypes
+    save_time_index(path, index)
+    logger.info(f"  {os.path.basename(path)} : {len(index.offsets)} marks "
+                f"-> {get_time_index_path(path)}")
+
+
+def index_dir(path: str, ext: str, step: int):
+    if not os.path.exists(path):
+        logger.warning(f"Path does not exist: {path}")
+        return
+    logger.info(f"Indexing      : {path}")
+    for name in sorted(os.listdir(path)):
+        if not name.endswith(ext):
+            continue
+        filepath: str = os.path.join(path, name)
+        if ext == '.csv':
+            with open(filepath, 'rb') as f:
+                header: bytes = f.readline()
+            get_time = get_revents_line_isotime_func(header)
+            if not get_time:
+                logger.warning(f"  {name} : no client_time_iso column, "
+                               f"skipped")
+                continue
+            index_file(filepath, get_time, step, len(header),
+                       get_revents_dtypes(filepath))
+        elif ext == '.jsonl':
+            index_file(filepath, get_birch_line_isotime, step)
+        else:
+            index_file(filepath, get_psychopy_line_isotime, step)
+
+
+@click.command(help='Build sidecar time index files for session raw '
+                    'birch, reproevents and psychopy logs.')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--step', default=1000, type=int,
+              help='Number of log lines between index marks')
+@click.option('--log-level', default='INFO',
+              type=click.Choice(['DEBUG', 'INFO',
+                                 'WARNING', 'ERROR',
+                                 'CRITICAL']),
+              help='Set the logging level')
+@click.pass_context
+def main(ctx, path: str, step: int, log_level):
+    logger.setLevel(log_level)
+    logger.debug("build_time_index.py tool")
+    logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
+    logger.info(f"Session path  : {path}")
+    logger.info(f"Session ID    : {get_session_id(path)}")
+
+    index_dir(os.path.join(path, "birch"), '.jsonl', step)
+    index_dir(os.path.join(path, "reproevents"), '.csv', step)
+    index_dir(os.path.join(path, "psychopy"), '.log', step)
+    return 0
+
+
+if __name__ == "__main__":
+    code = main(standalone_mode=False)
+    logger.info(f"Exit on   : {datetime.now()}")
+    logger.info(f"Exit code : {code}")
+    sys.exit(code)
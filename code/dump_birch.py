@@ -10,12 +10,13 @@ from collections import OrderedDict
 import click
 import logging
 import jsonlines
-import pandas as pd
 
 from repronim_dumps import DumpsConfig, do_config
 from repronim_timing import (TMapService, Clock, dump_jsonl,
                              find_study_range, generate_id,
-                             get_session_id, get_tmap_svc)
+                             get_session_id, get_tmap_svc, parse_isotime,
+                             seek_isotime, load_time_index, LOG_TIME_SLACK,
+                             jsonl_output, get_dump_file)
 
 
 # initialize the logger
@@ -42,20 +43,28 @@ def calc_tick_interval(tick_start: float, tick_end: float) -> float:
         return (0xFFFFFFFF - tick_start + tick_end) + 1
 
 
-def get_birch_isotime(obj: dict) -> datetime:
-    iso_time_str: str = obj['iso_time']
-    if not iso_time_str:
+# get birch record isotime, None when there is no iso_time
+def get_birch_isotime(obj: dict) -> Optional[datetime]:
+    iso_time_str: str = obj.get('iso_time')
+    return parse_isotime(iso_time_str)
+
+
+# parse birch log line isotime, None for comments or invalid lines
+def get_birch_line_isotime(line: bytes) -> Optional[datetime]:
+    line = line.strip()
+    if not line or line.startswith(b'#'):
+        return None
+    try:
+        return get_birch_isotime(json.loads(line))
+    except Exception:
         return None
-    iso_time_pd = pd.to_datetime(iso_time_str)
-    iso_time_local = iso_time_pd.tz_convert('America/New_York')
-    iso_time = iso_time_local.tz_localize(None)
-    return iso_time
 
 
-def safe_jsonl_reader(path):
-    with open(path, 'r') as file:
+def safe_jsonl_reader(path, start: int = 0):
+    with open(path, 'rb') as file:
+        file.seek(start)
         for line in file:
-            line = line.strip()
+            line = line.decode('utf-8').strip()
             if line and not line.startswith('#'):
                 try:
                     # Parse JSON and yield
@@ -69,15 +78,31 @@ def safe_jsonl_reader(path):
 def dump_birch_file(session_id: str, path: str, range_start: datetime,
                     range_end: datetime):
     logger.debug(f"Processing    : {path}")
+    # birch log is time-ordered, so skip records before study range,
+    # with a margin for timestamps jitter
+    with open(path, 'rb') as f:
+        start: int = seek_isotime(f, range_start - LOG_TIME_SLACK,
+                                  get_birch_line_isotime,
+                                  index=load_time_index(path))
+    logger.debug(f"Seek offset   : {start}")
     lst_obj: list = []
-    lst_bit8: list = []
-    for obj in safe_jsonl_reader(path):
-        alink_byte = obj.get('alink_byte')
+    # last dumped flagged record isotime and tick
+    last_time: Optional[datetime] = None
+    last_tick: Optional[float] = None
+    # flagged records waiting for the flag off, as (obj, isotime, tick)
+    lst_bit8: List[Tuple[dict, datetime, float]] = []
+    # last known record isotime, closes flags on records without iso_time
+    seen_time: Optional[datetime] = None
+    for obj in safe_jsonl_reader(path, start):
         alink_flags = obj.get('alink_flags')
+        # parse record time only once
+        iso_time: Optional[datetime] = get_birch_isotime(obj)
+        tick: float = obj.get('time')
         # check alink_byte bit 8 is on e.g. 496
         #if alink_byte and (alink_byte & 0x100) !=0 : # and obj.get('alink_flags') == 3:
-        if alink_flags and (alink_flags & 0x0001) != 0:
-            iso_time = get_birch_isotime(obj)
+        if alink_flags and (alink_flags & 0x0001) != 0 and iso_time is None:
+            logger.debug(f"Skipping flagged record without iso_time {obj}")
+        elif alink_flags and (alink_flags & 0x0001) != 0:
             logger.debug(f"  {iso_time.isoformat()} {obj['alink_byte']} {obj['alink_flags']}")
             if range_start <= iso_time <= range_end:
                 obj['id'] = generate_id('birch')
@@ -93,23 +118,18 @@ def dump_birch_file(session_id: str, path: str, range_start: datetime,
 
                 # calculate the duration between the last 8-th bit on
                 if len(lst_obj) > 0:
-                    t2: datetime = get_birch_isotime(obj)
-                    tick2: float = obj.get('time')
-                    t1: datetime = get_birch_isotime(lst_obj[-1])
-                    tick1: float = lst_obj[-1].get('time')
-                    if t1 and t2:
-                        obj['duration_isotime'] = (t2 - t1).total_seconds()
-                    if tick1 and tick2:
-                        obj['duration'] = calc_tick_interval(tick1, tick2)
+                    if last_time and iso_time:
+                        obj['duration_isotime'] = (iso_time - last_time).total_seconds()
+                    if last_tick and tick:
+                        obj['duration'] = calc_tick_interval(last_tick, tick)
                 lst_obj.append(obj)
-                lst_bit8.append(obj)
+                last_time, last_tick = iso_time, tick
+                lst_bit8.append((obj, iso_time, tick))
             else:
                 logger.debug(f"Skipping out of study range "
                              f"isotime={iso_time.isoformat()},  {obj}")
         else:
             logger.debug(f"Skipping by alink_byte/alink_flags filter {obj}")
-            #for o in lst_bit8:
-            #    dump_jsonl(o)
             if len(lst_bit8)>0:
                 # NOTE: maybe we need to calculate the duration
                 # based on "time", which according to the birch
@@ -117,17 +137,23 @@ def dump_birch_file(session_id: str, path: str, range_start: datetime,
                 # https://abyz.me.uk/rpi/pigpio/python.html#get_current_tick
                 # the number of microseconds since system boot. As an unsigned
                 # 32 bit quantity tick wraps around approximately every 71.6 minutes.
-                t2: datetime = get_birch_isotime(obj)
-                tick2: float = obj.get('time')
-                for o in lst_bit8:
-                    t1: datetime = get_birch_isotime(o)
-                    tick1: float = o.get('time')
+                t2: Optional[datetime] = iso_time or seen_time
+                for o, t1, tick1 in lst_bit8:
                     if t1 and t2:
                         o['flag_duration_isotime'] = (t2 - t1).total_seconds()
-                    if tick1 and tick2:
-                        o['flag_duration'] = calc_tick_interval(tick1, tick2)
+                    if tick1 and tick:
+                        o['flag_duration'] = calc_tick_interval(tick1, tick)
 
                 lst_bit8 = []
+        if iso_time:
+            seen_time = iso_time
+
+        # nothing else to calculate after study range end, with a
+        # margin for timestamps jitter
+        if not lst_bit8 and iso_time and \
+                iso_time > range_end + LOG_TIME_SLACK:
+            logger.debug(f"Stop processing after study range end")
+            break
 
     # dump the list of objects
     if lst_obj:
@@ -156,8 +182,11 @@ def dump_birch_all(session_id: str,  path: str, range_start: datetime,
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_birch.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -180,7 +209,7 @@ def main(ctx, path: str, log_level):
         logger.error(f"Dumps path does not exist: {dumps_path}")
         return 1
 
-    dump_dicoms_path = os.path.join(dumps_path, "dump_dicoms.jsonl")
+    dump_dicoms_path = get_dump_file(dumps_path, "dump_dicoms")
     logger.info(f"DICOMS dump   : {dump_dicoms_path}")
 
     if not os.path.exists(dump_dicoms_path):
@@ -211,7 +240,8 @@ def main(ctx, path: str, log_level):
     logger.info(f"              : birch  {range_start} - {range_end}")
 
 
-    dump_birch_all(session_id, birch_path, range_start, range_end)
+    with jsonl_output(output):
+        dump_birch_all(session_id, birch_path, range_start, range_end)
 
     return 0
 
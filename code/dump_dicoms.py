@@ -3,17 +3,23 @@ import getpass
 import os
 import sys
 from collections import OrderedDict
+from itertools import chain
+from concurrent.futures import ProcessPoolExecutor
 
 from pydantic import BaseModel, Field
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Optional, List, Dict, Tuple
 
 import click
+import jsonlines
 import pydicom
+from pydicom.multival import MultiValue
 import logging
 
-from repronim_timing import (dump_jsonl, get_session_id, generate_id)
-from repronim_dumps import DicomsRecord, StudyRecord, SeriesRecord
+from repronim_timing import (dump_jsonl, get_session_id, generate_id,
+                             jsonl_output, get_study_summary_path)
+from repronim_dumps import (DicomsRecord, StudyRecord, SeriesRecord,
+                            DumpStampRecord)
 
 
 # initialize the logger
@@ -32,45 +38,123 @@ def parse_mri_datetime(date: str, time: str) -> datetime:
     return datetime.strptime(f"{date} {time}", "%Y%m%d %H%M%S.%f")
 
 
-def dump_dicoms_file(session_id: str, dicoms_folder: str, path: str):
-    # DICOM tag for Content Time
-    acq_time_tag = (0x0008, 0x0032)
-    acq_date_tag = (0x0008, 0x0022)
-    study_tag = (0x0008, 0x1030)
-    series_tag = (0x0008, 0x103E)
+# DICOM tags used in dumps
+DICOMS_TAGS = {
+    'AcquisitionTime': (0x0008, 0x0032),
+    'AcquisitionDate': (0x0008, 0x0022),
+    'StudyDescription': (0x0008, 0x1030),
+    'SeriesDescription': (0x0008, 0x103E),
+}
 
+# name of DICOM headers cache file in timing-dumps folder
+DICOMS_CACHE_FILE = 'dump_dicoms_cache.jsonl'
+
+
+# convert DICOM element value to string, so it can be stored in
+# cache, multi-valued elements are joined with backslash as in DICOM
+def to_tag_str(v) -> Optional[str]:
+    if v is None:
+        return None
+    if isinstance(v, MultiValue):
+        return '\\'.join(str(x) for x in v)
+    return str(v)
+
+
+# read only header tags used in dumps from DICOM file, pixel data
+# is never loaded
+def read_dicoms_tags(path: str) -> Dict[str, str]:
+    ds = pydicom.dcmread(path, stop_before_pixels=True,
+                         specific_tags=list(DICOMS_TAGS.values()))
+    return {name: to_tag_str(ds[tag].value)
+            for name, tag in DICOMS_TAGS.items() if tag in ds}
+
+
+# load DICOM headers cache, maps "<series folder>/<file>" to entry
+# with file size, mtime and extracted tags
+def load_dicoms_cache(path: str) -> Dict[str, dict]:
+    if not os.path.exists(path):
+        return {}
+    try:
+        with jsonlines.open(path) as reader:
+            return {obj['name']: obj for obj in reader}
+    except Exception as e:
+        logger.warning(f"Failed to load DICOMs cache {path}: {e}")
+        return {}
+
+
+def save_dicoms_cache(path: str, cache: Dict[str, dict]):
+    tmp_path: str = f"{path}.tmp"
+    with jsonlines.open(tmp_path, mode='w') as writer:
+        writer.write_all(cache[name] for name in sorted(cache))
+    os.replace(tmp_path, path)
+
+
+# scan all *.dcm files in series folder, can be executed in worker
+# process, returns (name, tags, error, cache entry) list in sorted
+# files order. Files with the same size and mtime as in cache are
+# not read again.
+def scan_dicoms_dir(path: str, cache: Optional[Dict[str, dict]] = None
+                    ) -> List[Tuple[str, Optional[Dict], Optional[str],
+                                    Optional[dict]]]:
+    dicoms_folder: str = os.path.basename(path)
+    res = []
+    for name in sorted(os.listdir(path)):
+        if not name.endswith('.dcm'):
+            res.append((name, None, None, None))
+            continue
+        filepath: str = os.path.join(path, name)
+        try:
+            st = os.stat(filepath)
+            key: str = f"{dicoms_folder}/{name}"
+            entry: dict = cache.get(key) if cache else None
+            if not (entry and entry['size'] == st.st_size and
+                    entry['mtime_ns'] == st.st_mtime_ns):
+                entry = {'name': key,
+                         'size': st.st_size,
+                         'mtime_ns': st.st_mtime_ns,
+                         'tags': read_dicoms_tags(filepath)}
+            res.append((name, entry['tags'], None, entry))
+        except Exception as e:
+            res.append((name, None, str(e), None))
+    return res
+
+
+def dump_dicoms_file(session_id: str, dicoms_folder: str, path: str,
+                     tags: Optional[Dict] = None, error: str = None):
     try:
-        # Read the DICOM file
-        ds = pydicom.dcmread(path)
+        if error:
+            raise Exception(error)
+        if tags is None:
+            tags = read_dicoms_tags(path)
 
         dr: DicomsRecord = DicomsRecord(
             id=generate_id("dicoms"),
             session_id=session_id,
             series_folder=dicoms_folder)
         # calc study
-        if study_tag in ds:
-            dr.study = ds[study_tag].value
+        if 'StudyDescription' in tags:
+            dr.study = tags['StudyDescription']
             logger.info(f"    Study           = {dr.study}")
         else:
             logger.info(f"    Study not found")
 
         # calc series
-        if series_tag in ds:
-            dr.series = ds[series_tag].value
+        if 'SeriesDescription' in tags:
+            dr.series = tags['SeriesDescription']
             logger.info(f"    Series          = {dr.series}")
         else:
             logger.info(f"    Series not found")
 
         # calc date
-        if acq_date_tag in ds:
-            dr.acquisition_date = ds[acq_date_tag].value
+        if 'AcquisitionDate' in tags:
+            dr.acquisition_date = tags['AcquisitionDate']
             logger.info(f"    AcquisitionDate = {dr.acquisition_date}")
         else:
             logger.info(f"    AcquisitionDate not found")
 
         # calc time
-        if acq_time_tag in ds:
-            dr.acquisition_time = ds[acq_time_tag].value
+        if 'AcquisitionTime' in tags:
+            dr.acquisition_time = tags['AcquisitionTime']
             logger.info(f"    AcquisitionTime = {dr.acquisition_time}")
         else:
             logger.info(f"    AcquisitionTime not found")
@@ -85,35 +169,76 @@ def dump_dicoms_file(session_id: str, dicoms_folder: str, path: str):
         logger.error(f"Error reading {path}: {e}")
 
 
-def dump_dicoms_dir(session_id: str, path: str):
+def dump_dicoms_dir(session_id: str, path: str, scan: List = None):
     #logger.debug(f"Reading DICOM dir {path}")
     # get containing folder name
     dicoms_folder: str = os.path.basename(path)
 
-    for name in sorted(os.listdir(path)):
+    if scan is None:
+        scan = scan_dicoms_dir(path)
+
+    for name, tags, error, _ in scan:
         # check if file is *.dcm
         if name.endswith('.dcm'):
             filepath = os.path.join(path, name)
             logger.debug(f"  {name}")
             yield from dump_dicoms_file(session_id,
                                         dicoms_folder,
-                                        filepath)
+                                        filepath, tags, error)
         else:
             logger.debug(f"Skipping file: {name}")
 
 
-def dump_dicoms_all(session_id: str, path: str):
+# dump all series folders, headers are scanned in parallel by jobs
+# worker processes and records are produced in sorted folders/files
+# order, so generated ids are the same as for serial scan. When cache
+# is specified, it is used to skip unchanged files and updated in
+# place with entries for all currently present files.
+def dump_dicoms_all(session_id: str, path: str, jobs: int = 1,
+                    cache: Optional[Dict[str, dict]] = None):
     logger.debug(f"Reading DICOM root : {path}")
+    dirs: List[str] = []
     # Loop through all .dcm files in the directory
     for name in sorted(os.listdir(path)):
         # check if file is directory
         path2 = os.path.join(path, name)
         if os.path.isdir(path2):
-            logger.debug(f"Reading DICOM dir  : {name}")
-            yield from dump_dicoms_dir(session_id, path2)
+            dirs.append(path2)
         else:
             logger.debug(f"Skipping file: {name}")
 
+    # split cache entries by series folder
+    dir_caches: Dict[str, Dict[str, dict]] = {}
+    for key, entry in (cache or {}).items():
+        dir_caches.setdefault(key.split('/', 1)[0], {})[key] = entry
+    dir_caches_list = [dir_caches.get(os.path.basename(path2))
+                       for path2 in dirs]
+
+    executor: Optional[ProcessPoolExecutor] = None
+    if jobs > 1 and len(dirs) > 1:
+        executor = ProcessPoolExecutor(max_workers=jobs)
+        scans = executor.map(scan_dicoms_dir, dirs, dir_caches_list)
+    else:
+        scans = map(scan_dicoms_dir, dirs, dir_caches_list)
+
+    entries: Dict[str, dict] = {}
+    try:
+        for path2, scan in zip(dirs, scans):
+            logger.debug(f"Reading DICOM dir  : {os.path.basename(path2)}")
+            entries.update((entry['name'], entry)
+                           for _, _, _, entry in scan if entry)
+            yield from dump_dicoms_dir(session_id, path2, scan)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    if cache is not None:
+        cached: int = sum(1 for k, v in entries.items() if cache.get(k) == v)
+        logger.info(f"DICOMs cache  : {cached} cached, "
+                    f"{len(entries) - cached} parsed")
+        cache.clear()
+        cache.update(entries)
+
 
 @click.command(help='Dump DICOM files date time info.')
 @click.argument('path', type=click.Path(exists=True))
@@ -122,8 +247,17 @@ def dump_dicoms_all(session_id: str, path: str):
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('--cache/--no-cache', default=True,
+              help='Use DICOM headers cache stored in timing-dumps '
+                   'folder to parse only new or changed files')
+@click.option('--jobs', default=1, type=int,
+              help='Number of worker processes used to scan DICOM '
+                   'headers, 1 (default) to scan serially')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, cache: bool, jobs: int, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_dicoms.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -146,97 +280,124 @@ def main(ctx, path: str, log_level):
         logger.error(f"DICOMS path does not exist: {dicoms_path}")
         return 1
 
-    map_study = OrderedDict()
-    map_series = OrderedDict()
-    # specify delta time range as 1 hour
-    range_delta = timedelta(minutes=2)
-    for item in dump_dicoms_all(session_id, dicoms_path):
-        if item.study:
-            # build study map
-            if item.study in map_study:
-                sr: StudyRecord = map_study[item.study]
-                # update time if any
-                if item.acquisition_isotime < sr.isotime_start:
-                    sr.isotime_start = item.acquisition_isotime
-                    sr.range_isotime_start = sr.isotime_start - range_delta
-                    sr.time_start = item.acquisition_time
-                    sr.date_start = item.acquisition_date
-                    sr.duration = calc_duration(sr.isotime_start,
-                                                sr.isotime_end)
-                if item.acquisition_isotime > sr.isotime_end:
-                    sr.isotime_end = item.acquisition_isotime
-                    sr.range_isotime_end = sr.isotime_end + range_delta
-                    sr.time_end = item.acquisition_time
-                    sr.date_end = item.acquisition_date
-                    sr.duration = calc_duration(sr.isotime_start,
-                                                sr.isotime_end)
-            else:
-                # create study
-                sr: StudyRecord = StudyRecord(
-                    id=generate_id("study"),
-                    session_id=session_id,
-                    name=item.study,
-                    series_count=0,
-                    time_start=item.acquisition_time,
-                    date_start=item.acquisition_date,
-                    isotime_start=item.acquisition_isotime,
-                    range_isotime_start=item.acquisition_isotime - range_delta,
-                    time_end=item.acquisition_time,
-                    date_end=item.acquisition_date,
-                    isotime_end=item.acquisition_isotime,
-                    range_isotime_end=item.acquisition_isotime + range_delta,
-                    duration=0.0
-                )
-                map_study[item.study] = sr
-
-            # build series map
-            if item.series:
-                skey: str = f"{item.study}|{item.series}|{item.series_folder}"
-                if skey in map_series:
-                    ss: SeriesRecord = map_series[skey]
-                    ss.dicom_count += 1
+    cache_path: str = os.path.join(path, "timing-dumps", DICOMS_CACHE_FILE)
+    dicoms_cache: Optional[Dict[str, dict]] = None
+    if cache:
+        logger.info(f"DICOMs cache  : {cache_path}")
+        dicoms_cache = load_dicoms_cache(cache_path)
+
+    with jsonl_output(output):
+        map_study = OrderedDict()
+        map_series = OrderedDict()
+        # specify delta time range as 1 hour
+        range_delta = timedelta(minutes=2)
+        for item in dump_dicoms_all(session_id, dicoms_path, jobs,
+                                    dicoms_cache):
+            if item.study:
+                # build study map
+                if item.study in map_study:
+                    sr: StudyRecord = map_study[item.study]
                     # update time if any
-                    if item.acquisition_isotime < ss.isotime_start:
-                        ss.isotime_start = item.acquisition_isotime
-                        ss.time_start = item.acquisition_time
-                        ss.date_start = item.acquisition_date
-                        ss.duration = calc_duration(ss.isotime_start,
-                                                    ss.isotime_end)
-                    if item.acquisition_isotime > ss.isotime_end:
-                        ss.isotime_end = item.acquisition_isotime
-                        ss.time_end = item.acquisition_time
-                        ss.date_end = item.acquisition_date
-                        ss.duration = calc_duration(ss.isotime_start,
-                                                    ss.isotime_end)
+                    if item.acquisition_isotime < sr.isotime_start:
+                        sr.isotime_start = item.acquisition_isotime
+                        sr.range_isotime_start = sr.isotime_start - range_delta
+                        sr.time_start = item.acquisition_time
+                        sr.date_start = item.acquisition_date
+                        sr.duration = calc_duration(sr.isotime_start,
+                                                    sr.isotime_end)
+                    if item.acquisition_isotime > sr.isotime_end:
+                        sr.isotime_end = item.acquisition_isotime
+                        sr.range_isotime_end = sr.isotime_end + range_delta
+                        sr.time_end = item.acquisition_time
+                        sr.date_end = item.acquisition_date
+                        sr.duration = calc_duration(sr.isotime_start,
+                                                    sr.isotime_end)
                 else:
-                    # create series
-                    ss: SeriesRecord = SeriesRecord(
-                        id=generate_id("series"),
+                    # create study
+                    sr: StudyRecord = StudyRecord(
+                        id=generate_id("study"),
                         session_id=session_id,
-                        name=item.series,
-                        folder=item.series_folder,
-                        dicom_count=1,
+                        name=item.study,
+                        series_count=0,
                         time_start=item.acquisition_time,
                         date_start=item.acquisition_date,
                         isotime_start=item.acquisition_isotime,
+                        range_isotime_start=item.acquisition_isotime - range_delta,
                         time_end=item.acquisition_time,
                         date_end=item.acquisition_date,
                         isotime_end=item.acquisition_isotime,
-                        study=item.study,
+                        range_isotime_end=item.acquisition_isotime + range_delta,
                         duration=0.0
                     )
-                    map_series[skey] = ss
-                    map_study[item.study].series_count += 1
-
-        dump_jsonl(item)
-
-    #dump study
-    for k, v in map_study.items():
-        dump_jsonl(v)
-
-    #dump series
-    for k, v in map_series.items():
-        dump_jsonl(v)
+                    map_study[item.study] = sr
+
+                # build series map
+                if item.series:
+                    skey: str = f"{item.study}|{item.series}|{item.series_folder}"
+                    if skey in map_series:
+                        ss: SeriesRecord = map_series[skey]
+                        ss.dicom_count += 1
+                        # update time if any
+                        if item.acquisition_isotime < ss.isotime_start:
+                            ss.isotime_start = item.acquisition_isotime
+                            ss.time_start = item.acquisition_time
+                            ss.date_start = item.acquisition_date
+                            ss.duration = calc_duration(ss.isotime_start,
+                                                        ss.isotime_end)
+                        if item.acquisition_isotime > ss.isotime_end:
+                            ss.isotime_end = item.acquisition_isotime
+                            ss.time_end = item.acquisition_time
+                            ss.date_end = item.acquisition_date
+                            ss.duration = calc_duration(ss.isotime_start,
+                                                        ss.isotime_end)
+                    else:
+                        # create series
+                        ss: SeriesRecord = SeriesRecord(
+                            id=generate_id("series"),
+                            session_id=session_id,
+                            name=item.series,
+                            folder=item.series_folder,
+                            dicom_count=1,
+                            time_start=item.acquisition_time,
+                            date_start=item.acquisition_date,
+                            isotime_start=item.acquisition_isotime,
+                            time_end=item.acquisition_time,
+                            date_end=item.acquisition_date,
+                            isotime_end=item.acquisition_isotime,
+                            study=item.study,
+                            duration=0.0
+                        )
+                        map_series[skey] = ss
+                        map_study[item.study].series_count += 1
+
+            dump_jsonl(item)
+
+        #dump study
+        for k, v in map_study.items():
+            dump_jsonl(v)
+
+        #dump series
+        for k, v in map_series.items():
+            dump_jsonl(v)
+
+    # save study/series summary next to the dump, so dependent dumps
+    # don't need to scan the whole dump to find study range. Dump path
+    # is not known for stdout output, so summary is not saved then.
+    if output:
+        summary_path: str = get_study_summary_path(output)
+        logger.info(f"Study summary : {summary_path}")
+        os.makedirs(os.path.dirname(os.path.abspath(summary_path)),
+                    exist_ok=True)
+        st = os.stat(output)
+        with jsonl_output(summary_path):
+            dump_jsonl(DumpStampRecord(size=st.st_size,
+                                       mtime_ns=st.st_mtime_ns))
+            for v in chain(map_study.values(), map_series.values()):
+                dump_jsonl(v)
+
+    if dicoms_cache is not None:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        save_dicoms_cache(cache_path, dicoms_cache)
 
     return 0
 
@@ -4,21 +4,23 @@ import getpass
 import os
 import sys
 from enum import Enum
-from itertools import chain
+from itertools import chain, islice
 from pathlib import Path
 
 from pydantic import BaseModel, Field
 from datetime import datetime
-from typing import Optional, List
+from typing import Optional, List, Iterable, Generator, Tuple
 import jsonlines
+import numpy as np
 import pandas as pd
 
 import click
 import logging
 
-from repronim_timing import (TMapService, Clock, parse_jsonl,
+from repronim_timing import (TMapService, Clock, parse_jsonl_gen,
                              generate_id, dump_jsonl,
-                             get_session_id, get_tmap_svc)
+                             get_session_id, get_tmap_svc, parse_isotime,
+                             jsonl_output, get_dump_file)
 from repronim_dumps import (MarkRecord, init_config, get_config,
                             DumpsConfig, do_config)
 
@@ -79,7 +81,42 @@ class SeriesData(BaseModel):
     synced_isotime_end: Optional[datetime] = Field(None, description="Series end global"
                                                                 "datetime w/o "
                                                               "last item")
-
+    # cross-correlation alignment with DICOMs series if any
+    offset: Optional[float] = Field(None, description="Offset of series events "
+                                                      "relative to DICOMs series "
+                                                      "events in global clock, "
+                                                      "in seconds")
+    confidence: Optional[float] = Field(None, description="Fraction of DICOMs series "
+                                                          "events matched")
+
+
+# Series index by synced start time, sorted start times are used to
+# find series within time tolerance window by binary search instead
+# of checking all swimlane series
+class SeriesIndex:
+    def __init__(self, series: List[SeriesData]):
+        self.series: List[SeriesData] = series
+        starts: np.ndarray = pd.to_datetime(pd.Series(
+            [sd.synced_isotime_start for sd in series],
+            dtype=object)).to_numpy(dtype='datetime64[ns]')
+        self._order: np.ndarray = np.argsort(starts, kind='stable')
+        self._starts: np.ndarray = starts[self._order]
+
+    # find indexes of series which synced start is within tolerance
+    # seconds of isotime, in the series order
+    def find(self, isotime: datetime, tolerance: float) -> np.ndarray:
+        if isotime is None:
+            return np.empty(0, dtype=np.int64)
+        dt: np.datetime64 = pd.Timestamp(isotime).to_datetime64()
+        # pad window, exact check is done by series matching
+        delta: np.timedelta64 = np.timedelta64(int((tolerance + 1.0) * 1e9), 'ns')
+        lo: int = np.searchsorted(self._starts, dt - delta, side='left')
+        hi: int = np.searchsorted(self._starts, dt + delta, side='right')
+        return np.sort(self._order[lo:hi])
+
+    def find_series(self, isotime: datetime,
+                    tolerance: float) -> List[SeriesData]:
+        return [self.series[i] for i in self.find(isotime, tolerance)]
 
 
 # Define swimlane object model
@@ -100,6 +137,8 @@ class SwimlaneModel(BaseModel):
                                                                 "in the swimlane")
     series: Optional[List[SeriesData]] = Field([], description="List of detected series "
                                                                "for the swimlane")
+    series_index: Optional[object] = Field(None, description="Series index by synced "
+                                                             "start time")
 
 
 # Define dump model
@@ -142,16 +181,6 @@ class DumpModel(BaseModel):
         return self.map_by_id.get(uid)
 
 
-def parse_isotime(v: str) -> datetime:
-    if not v:
-        return None
-    ts = pd.to_datetime(v)
-    if ts.tzinfo is not None:
-        ts = ts.tz_convert('America/New_York')
-    isotime = ts.tz_localize(None)
-    return isotime
-
-
 # calculate interval between first and last dicom in series if
 # series has more than 1 dicoms
 def calc_dicoms_series_interval(series: List) -> float:
@@ -164,97 +193,132 @@ def calc_dicoms_series_interval(series: List) -> float:
     return 2.0
 
 
-# Get swimlane dump file path
+# Get swimlane dump file path, JSONL or Parquet one
 def get_dump_path(path: str, swimlane: SwimlaneModel) -> str:
-    return os.path.join(path, f"dump_{swimlane.name}.jsonl")
-
-
-# Find birch series based on DICOMs series interval
+    return get_dump_file(path, f"dump_{swimlane.name}")
+
+
+# Get dump fields used by swimlane events, DICOMs events keep also
+# study and series info to detect func series
+def get_swimlane_fields(swimlane: SwimlaneModel) -> List[str]:
+    fields: List[str] = ['type', 'id', swimlane.isotime_field]
+    if swimlane.duration_field:
+        fields.append(swimlane.duration_field)
+    if swimlane.name == Swimlane.DICOMS:
+        fields += ['study', 'series', 'series_folder']
+    return fields
+
+
+# Load swimlane dump objects of swimlane event type only, and only
+# fields used by swimlane events
+def load_swimlane_objs(path: str,
+                       swimlane: SwimlaneModel) -> Generator[dict, None, None]:
+    return parse_jsonl_gen(
+        get_dump_path(path, swimlane),
+        types=[swimlane.event_type] if swimlane.event_type else None,
+        fields=get_swimlane_fields(swimlane))
+
+
+# Find birch series based on DICOMs series interval. Series are runs
+# of events which duration is within interval tolerance, the run ends
+# with the first event out of tolerance and only runs with more than 5
+# events are considered. Events are processed in chunks of chunk_size
+# with NumPy, and only events of the current run are carried over
+# between chunks. Trailing run not ended by out of tolerance event is
+# not considered.
 def find_swimlane_series(swimlane: SwimlaneModel,
-                         interval: float) -> List[SeriesData]:
+                         interval: float,
+                         events: Iterable[EventData] = None,
+                         chunk_size: int = 65536) -> List[SeriesData]:
     lst: List[SeriesData] = []
     dt_min:float = interval * 0.8
     dt_max:float = interval * 1.2
 
-    # check for an empty list
-    if not swimlane.events:
-        return lst
-
-    # check for a list with less than 2 items
-    if len(swimlane.events) < 2:
-        return lst
-
-    last_isotime: datetime = None
-    evts: List = []
-    for evt in chain(swimlane.events, [swimlane.events[0]]):
-        isotime: datetime = evt.isotime
-        if len(evts) == 0:
-            evts.append(evt)
-            last_isotime = isotime
+    if events is None:
+        events = swimlane.events
+
+    it = iter(events)
+    runs: List[List[EventData]] = []
+    skipped: int = 0
+    evts: List[EventData] = []
+    while True:
+        chunk: List[EventData] = list(islice(it, chunk_size))
+        if not chunk:
+            break
+        evts += chunk
+        durations: np.ndarray = np.fromiter((evt.duration for evt in evts),
+                                            dtype=float, count=len(evts))
+        ends: np.ndarray = np.flatnonzero(~((dt_min <= durations) &
+                                            (durations <= dt_max)))
+        if len(ends) == 0:
             continue
+        starts: np.ndarray = np.concatenate(([0], ends[:-1] + 1))
+        # consider only more than 5 objects in series
+        counts: np.ndarray = ends - starts + 1
+        for start, end in zip(starts[counts > 5].tolist(),
+                              ends[counts > 5].tolist()):
+            runs.append(evts[start:end + 1])
+        skipped += int(np.count_nonzero(counts <= 5))
+        evts = evts[ends[-1] + 1:]
+    logger.debug(f"Skip {skipped} {swimlane.name} series (too small)")
+    if not runs:
+        return lst
 
-        if dt_min <= evts[-1].duration <= dt_max:
-            evts.append(evt)
-        else:
-            # consider only more than 5 objects in series
-            if len(evts) > 5:
-                sd: SeriesData = SeriesData()
-                sd.swimlane = swimlane
-                sd.events = evts
-                sd.data = [o.data for o in evts]
-                sd.count = len(evts)
-                sd.name = f"{swimlane.name}-series-{(len(lst)+1)}"
-                sd.isotime_start = evts[0].isotime
-                sd.isotime_end = evts[-1].isotime
-                sd.synced_isotime_start = get_tmap_svc().convert(
-                    swimlane.clock, Clock.ISOTIME, sd.isotime_start)
-                sd.synced_isotime_end = get_tmap_svc().convert(
-                    swimlane.clock, Clock.ISOTIME, sd.isotime_end)
-                sd.interval = (last_isotime - sd.isotime_start).total_seconds() / (sd.count-1)
-                sd.next_series_interval = 0
-                sd.duration = (sd.isotime_end - sd.isotime_start).total_seconds()
-                if len(lst) > 0:
-                    lst[-1].next_series_interval = (
-                        (sd.isotime_start - lst[-1].isotime_start).total_seconds())
-                lst.append(sd)
-            else:
-                logger.debug(f"Skip {swimlane.name} series (too small={len(evts)}): {[evt.id for evt in evts]}")
-            evts = []
-            evts.append(evt)
-
-        last_isotime = isotime
+    # convert all series bounds to global clock in one call
+    synced = get_tmap_svc().convert_many(
+        swimlane.clock, Clock.ISOTIME,
+        pd.Series([run[0].isotime for run in runs] +
+                  [run[-1].isotime for run in runs],
+                  dtype='datetime64[ns]'))
+    for i, run in enumerate(runs):
+        sd: SeriesData = SeriesData()
+        sd.swimlane = swimlane
+        sd.events = run
+        sd.count = len(run)
+        sd.name = f"{swimlane.name}-series-{(len(lst)+1)}"
+        sd.isotime_start = run[0].isotime
+        sd.isotime_end = run[-1].isotime
+        sd.synced_isotime_start = synced.iloc[i]
+        sd.synced_isotime_end = synced.iloc[len(runs) + i]
+        sd.interval = (sd.isotime_end - sd.isotime_start).total_seconds() / (sd.count-1)
+        sd.next_series_interval = 0
+        sd.duration = (sd.isotime_end - sd.isotime_start).total_seconds()
+        if len(lst) > 0:
+            lst[-1].next_series_interval = (
+                (sd.isotime_start - lst[-1].isotime_start).total_seconds())
+        lst.append(sd)
 
     return lst
 
 
-# Return list of list DICOMs object in each series
-def find_dicoms_func_series(model: DumpModel) -> List[SeriesData]:
-    df = pd.DataFrame(model.dicoms.data)
-    # filter by type, study and series
-    filtered_df = df[
-        (df['type'] == 'DicomsRecord') &
-        (df['study'] == 'dbic^QA') &
-        (df['series'].str.startswith('func-'))
-        ]
-
-    # group by series folder, rather than only series name
-    grouped_df = filtered_df.groupby('series_folder')
+# Return list of list DICOMs object in each series, only DICOMs
+# from func series of the study are kept
+def find_dicoms_func_series(swimlane: SwimlaneModel,
+                            events: Iterable[EventData] = None) -> List[SeriesData]:
+    if events is None:
+        events = swimlane.events
+
+    # filter by study and series, and group by series folder,
+    # rather than only series name
+    groups: dict = {}
+    for evt in events:
+        obj: dict = evt.data
+        series: str = obj.get('series')
+        if (obj.get('study') == 'dbic^QA' and series and
+                series.startswith('func-') and
+                obj.get('series_folder') is not None):
+            groups.setdefault(obj.get('series_folder'), []).append(evt)
 
     lst: List = []
     last_sd: SeriesData = None
-    for series, group in grouped_df:
+    for series in sorted(groups):
         sd: SeriesData = SeriesData()
-        sd.swimlane = model.dicoms
-        sd.events = [model.get_by_id(uid) for uid in group['id']]
-        sd.data = [model.get_by_id(uid).data for uid in group['id']]
+        sd.swimlane = swimlane
+        sd.events = groups[series]
         sd.count = len(sd.events)
         sd.name = series
         sd.isotime_start = sd.events[0].isotime
         sd.isotime_end = sd.events[-1].isotime
-        sd.synced_isotime_start = get_tmap_svc().convert(
-            Clock.DICOMS, Clock.ISOTIME, sd.isotime_start)
-        sd.synced_isotime_end = get_tmap_svc().convert(
-            Clock.DICOMS, Clock.ISOTIME, sd.isotime_end)
         sd.interval = calc_dicoms_series_interval(sd.events)
         sd.next_series_interval = 0.0
         sd.duration = (sd.isotime_end -
@@ -264,6 +328,17 @@ def find_dicoms_func_series(model: DumpModel) -> List[SeriesData]:
                 (sd.isotime_start - last_sd.isotime_start).total_seconds())
         lst.append(sd)
         last_sd = sd
+
+    # convert all series bounds to global clock in one call
+    synced_starts = get_tmap_svc().convert_many(
+        Clock.DICOMS, Clock.ISOTIME,
+        pd.Series([sd.isotime_start for sd in lst], dtype='datetime64[ns]'))
+    synced_ends = get_tmap_svc().convert_many(
+        Clock.DICOMS, Clock.ISOTIME,
+        pd.Series([sd.isotime_end for sd in lst], dtype='datetime64[ns]'))
+    for sd, start, end in zip(lst, synced_starts, synced_ends):
+        sd.synced_isotime_start = start
+        sd.synced_isotime_end = end
     return lst
 
 
@@ -369,10 +444,26 @@ def match_series_data(cfg: DumpsConfig, sd1: SeriesData, sd2: SeriesData) -> (bo
     return True, score
 
 
+# get synced start time tolerance used to match series of two
+# swimlanes, the same as in match_series_data
+def get_synced_tolerance(cfg: DumpsConfig, name1: str, name2: str) -> float:
+    if name1 == Swimlane.DICOMS or name2 == Swimlane.DICOMS:
+        return 2.0 if Swimlane.DICOMS in cfg.clock_offsets else 120.0
+    return 2.0
+
+
+# match series with the best series of the list, when index is
+# specified, only series within synced start tolerance are checked
 def match_series(cfg: DumpsConfig, sd1: SeriesData,
-                 series: List[SeriesData]) -> SeriesData:
+                 series: List[SeriesData],
+                 index: SeriesIndex = None) -> SeriesData:
     best_sd: SeriesData = None
     best_score: float = None
+    if index is not None and series:
+        series = index.find_series(
+            sd1.synced_isotime_start,
+            get_synced_tolerance(cfg, sd1.swimlane.name,
+                                 series[0].swimlane.name))
     for sd2 in series:
         match, score = match_series_data(cfg, sd1, sd2)
         if match:
@@ -394,9 +485,341 @@ def match_series(cfg: DumpsConfig, sd1: SeriesData,
     return best_sd
 
 
-def build_swimlane_events(swimlane: SwimlaneModel):
-    swimlane.events = []
-    for obj in swimlane.data:
+# series fields used in matching as arrays, missing values as 0
+def get_series_arrays(series: List[SeriesData]) -> dict:
+    return {
+        'count': np.array([sd.count or 0 for sd in series], dtype=np.int64),
+        'interval': np.array([sd.interval or 0.0 for sd in series],
+                             dtype=float),
+        'next_series_interval': np.array(
+            [sd.next_series_interval or 0.0 for sd in series], dtype=float),
+        'synced_isotime_start': pd.to_datetime(pd.Series(
+            [sd.synced_isotime_start for sd in series],
+            dtype=object)).to_numpy(dtype='datetime64[ns]'),
+        'qrinfo': np.array([sd.swimlane.name == Swimlane.QRINFO
+                            for sd in series], dtype=bool),
+        'dicoms': np.array([sd.swimlane.name == Swimlane.DICOMS
+                            for sd in series], dtype=bool),
+    }
+
+
+# match all series1 items (rows) with all series2 items (columns) at
+# once, the same checks as in match_series_data are applied. Returns
+# boolean match matrix and score matrix (synced start difference).
+def match_series_matrix(cfg: DumpsConfig, series1: List[SeriesData],
+                        series2: List[SeriesData]) -> (np.ndarray, np.ndarray):
+    a: dict = get_series_arrays(series1)
+    b: dict = get_series_arrays(series2)
+
+    # match item count
+    match: np.ndarray = a['count'][:, None] == b['count'][None, :]
+
+    # for QRINFO we allow 20% difference, because of the current problems with 0.3 sec
+    qrinfo: np.ndarray = a['qrinfo'][:, None] | b['qrinfo'][None, :]
+    k_min: np.ndarray = np.where(qrinfo, 0.80, 0.95)
+    k_max: np.ndarray = np.where(qrinfo, 1.20, 1.05)
+
+    # match interval and inter series interval, when both are set
+    for name in ['interval', 'next_series_interval']:
+        v1: np.ndarray = a[name][:, None]
+        v2: np.ndarray = b[name][None, :]
+        match &= ((v1 == 0) | (v2 == 0) |
+                  ((v1 * k_min <= v2) & (v2 <= v1 * k_max)))
+
+    # Kludge, skip check for QRINFO swimlane atm
+    n1: np.ndarray = a['next_series_interval'][:, None]
+    n2: np.ndarray = b['next_series_interval'][None, :]
+    match &= b['qrinfo'][None, :] | ~(((n1 == 0) & (n2 > 0)) |
+                                      ((n1 > 0) & (n2 == 0)))
+
+    # match synced start time, for DICOMs series we allow 120 sec
+    # difference, or 2 sec in case DICOMS correction provided manually
+    score: np.ndarray = np.abs(a['synced_isotime_start'][:, None] -
+                               b['synced_isotime_start'][None, :]) \
+        / np.timedelta64(1, 's')
+    dicoms: np.ndarray = a['dicoms'][:, None] | b['dicoms'][None, :]
+    dicoms_dt: float = 2.0 if Swimlane.DICOMS in cfg.clock_offsets else 120.0
+    match &= score <= np.where(dicoms, dicoms_dt, 2.0)
+    return match, score
+
+
+# align series one-to-one keeping their time order, with the maximal
+# number of matched pairs and then the minimal total score (ordered
+# DP alignment). Returns matched column index for each row or -1.
+def align_series(match: np.ndarray, score: np.ndarray) -> List[int]:
+    n, m = match.shape
+    # best matches count and total score for first i rows and
+    # first j columns, and step used to get there
+    counts: np.ndarray = np.zeros((n + 1, m + 1), dtype=np.int64)
+    totals: np.ndarray = np.zeros((n + 1, m + 1))
+    steps: np.ndarray = np.zeros((n + 1, m + 1), dtype=np.int8)
+    steps[1:, 0] = 1
+    steps[0, 1:] = 2
+    # cells of anti-diagonal i + j depend on two previous anti-diagonals
+    # only, so whole anti-diagonal is computed at once
+    for d in range(2, n + m + 1):
+        i: np.ndarray = np.arange(max(1, d - m), min(n, d - 1) + 1)
+        j: np.ndarray = d - i
+        # skip row
+        c: np.ndarray = counts[i - 1, j]
+        t: np.ndarray = totals[i - 1, j]
+        s: np.ndarray = np.ones(len(i), dtype=np.int8)
+        # skip column, wins ties
+        c2: np.ndarray = counts[i, j - 1]
+        t2: np.ndarray = totals[i, j - 1]
+        better: np.ndarray = (c2 > c) | ((c2 == c) & (t2 <= t))
+        c, t, s = np.where(better, c2, c), np.where(better, t2, t), \
+            np.where(better, 2, s)
+        # matched pair, wins ties
+        c3: np.ndarray = counts[i - 1, j - 1] + 1
+        t3: np.ndarray = totals[i - 1, j - 1] + score[i - 1, j - 1]
+        better = match[i - 1, j - 1] & ((c3 > c) | ((c3 == c) & (t3 <= t)))
+        counts[i, j] = np.where(better, c3, c)
+        totals[i, j] = np.where(better, t3, t)
+        steps[i, j] = np.where(better, 3, s)
+
+    res: List[int] = [-1] * n
+    i, j = n, m
+    while i > 0 and j > 0:
+        if steps[i, j] == 3:
+            res[i - 1] = j - 1
+            i, j = i - 1, j - 1
+        elif steps[i, j] == 1:
+            i -= 1
+        else:
+            j -= 1
+    return res
+
+
+# align series of all swimlanes with DICOMs func series, swimlanes
+# series are matched with reference swimlane series when it's already
+# aligned, or with DICOMs series otherwise. Returns map of matched
+# series by swimlane name for each DICOMs series.
+def align_model_series(cfg: DumpsConfig, model: DumpModel) -> List[dict]:
+    res: List[dict] = [{} for _ in model.dicoms.series]
+    for swiml in [model.birch, model.qrinfo, model.psychopy,
+                  model.reproevents]:
+        series1: List[SeriesData] = [
+            map_series.get(cfg.ref_swimlane) or dicoms_sd
+            for map_series, dicoms_sd in zip(res, model.dicoms.series)]
+        if not series1 or not swiml.series:
+            continue
+        # only series within synced start tolerance of any row are
+        # candidates
+        index: SeriesIndex = swiml.series_index or SeriesIndex(swiml.series)
+        cols: np.ndarray = np.unique(np.concatenate([
+            index.find(sd1.synced_isotime_start,
+                       get_synced_tolerance(cfg, sd1.swimlane.name,
+                                            swiml.name))
+            for sd1 in series1]))
+        if len(cols) == 0:
+            continue
+        candidates: List[SeriesData] = [swiml.series[j] for j in cols]
+        match, score = match_series_matrix(cfg, series1, candidates)
+        for i, j in enumerate(align_series(match, score)):
+            if j >= 0:
+                res[i][swiml.name] = candidates[j]
+                logger.debug(f"Aligned series: {series1[i].name} -> "
+                             f"{candidates[j].name}")
+                logger.debug(f"         score: {score[i, j]}")
+    return res
+
+
+# Define result of event trains cross-correlation alignment
+class TrainAlignment(BaseModel):
+    offset: Optional[float] = Field(None, description="Offset of swimlane events "
+                                                      "relative to reference events "
+                                                      "in global clock, in seconds")
+    confidence: Optional[float] = Field(0.0, description="Fraction of reference events "
+                                                         "matched at the offset")
+    pairs: Optional[List[Tuple[int, int]]] = Field([], description="Matched reference "
+                                                                   "and swimlane event "
+                                                                   "indexes")
+
+
+# convert events time to global clock, as float seconds since epoch
+def get_synced_times(clock: Clock, events: List[EventData]) -> np.ndarray:
+    dts = get_tmap_svc().convert_many(
+        clock, Clock.ISOTIME,
+        pd.Series([evt.isotime for evt in events], dtype='datetime64[ns]'))
+    return np.asarray(dts, dtype='datetime64[ns]').astype(np.int64) / 1e9
+
+
+# pair each reference time with the nearest time within tolerance
+# after shifting by offset, each time is paired at most once
+def pair_times(ref_times: np.ndarray, times: np.ndarray, order: np.ndarray,
+               offset: float, tolerance: float) -> List[Tuple[int, int]]:
+    sorted_times: np.ndarray = times[order]
+    expected: np.ndarray = ref_times + offset
+    if len(sorted_times) == 1:
+        nearest: np.ndarray = np.zeros(len(ref_times), dtype=np.int64)
+        dist: np.ndarray = np.abs(sorted_times[0] - expected)
+    else:
+        pos: np.ndarray = np.clip(np.searchsorted(sorted_times, expected),
+                                  1, len(sorted_times) - 1)
+        left: np.ndarray = np.abs(expected - sorted_times[pos - 1])
+        right: np.ndarray = np.abs(sorted_times[pos] - expected)
+        nearest = np.where(left <= right, pos - 1, pos)
+        dist = np.minimum(left, right)
+    best: dict = {}
+    for i in np.flatnonzero(dist <= tolerance).tolist():
+        j: int = int(nearest[i])
+        if j not in best or dist[i] < dist[best[j]]:
+            best[j] = i
+    return sorted((i, int(order[j])) for j, i in best.items())
+
+
+# align event trains by FFT cross-correlation of binned events, the
+# best lag is searched within max_lag seconds, then events are paired
+# within tolerance and offset is refined as median of paired events
+# differences. Dropped or extra events only lower the confidence.
+def xcorr_align_events(ref_times: np.ndarray, times: np.ndarray,
+                       max_lag: float, tolerance: float,
+                       bin_size: float = 0.05) -> TrainAlignment:
+    if len(ref_times) == 0 or len(times) == 0:
+        return TrainAlignment()
+    order: np.ndarray = np.argsort(times, kind='stable')
+    t0: float = ref_times.min() - max_lag
+    t1: float = ref_times.max() + max_lag
+    sorted_times: np.ndarray = times[order]
+    lo, hi = np.searchsorted(sorted_times, [t0, t1])
+    nbins: int = int(np.ceil((t1 - t0) / bin_size)) + 1
+
+    # binned trains, swimlane events are widened by tolerance and
+    # clipped so correlation counts matched reference events
+    ref: np.ndarray = np.zeros(nbins)
+    np.add.at(ref, ((ref_times - t0) / bin_size).astype(np.int64), 1.0)
+    train: np.ndarray = np.zeros(nbins)
+    np.add.at(train, ((sorted_times[lo:hi] - t0) / bin_size).astype(np.int64), 1.0)
+    width: int = int(round(tolerance / bin_size))
+    train = np.minimum(np.convolve(train, np.ones(2 * width + 1), 'same'), 1.0)
+
+    n: int = 1 << int(np.ceil(np.log2(2 * nbins)))
+    corr: np.ndarray = np.fft.irfft(np.conj(np.fft.rfft(ref, n)) *
+                                    np.fft.rfft(train, n), n)
+    max_bins: int = int(max_lag / bin_size)
+    lags: np.ndarray = np.arange(-max_bins, max_bins + 1)
+    values: np.ndarray = np.rint(corr[lags % n])
+    # the smallest lag of equal peaks, as events are widened by
+    # tolerance use the center of its plateau
+    peaks: np.ndarray = np.flatnonzero(values == values.max())
+    lo = hi = int(peaks[np.argmin(np.abs(lags[peaks]))])
+    while lo > 0 and values[lo - 1] == values[hi]:
+        lo -= 1
+    while hi < len(values) - 1 and values[hi + 1] == values[lo]:
+        hi += 1
+    lag: float = float(lags[lo] + lags[hi]) / 2 * bin_size
+
+    pairs: List[Tuple[int, int]] = pair_times(ref_times, times, order,
+                                              lag, tolerance)
+    if not pairs:
+        return TrainAlignment()
+    offset: float = float(np.median([times[j] - ref_times[i]
+                                     for i, j in pairs]))
+    pairs = pair_times(ref_times, times, order, offset, tolerance)
+    return TrainAlignment(offset=offset,
+                          confidence=len(pairs) / len(ref_times),
+                          pairs=pairs)
+
+
+# build swimlane series aligned with DICOMs series events, events not
+# matched with DICOMs series events are None
+def build_aligned_series(swimlane: SwimlaneModel, dicoms_sd: SeriesData,
+                         events: List[EventData],
+                         alignment: TrainAlignment) -> SeriesData:
+    evts: List[Optional[EventData]] = [None] * len(dicoms_sd.events)
+    for i, j in alignment.pairs:
+        evts[i] = events[j]
+    sd: SeriesData = SeriesData()
+    sd.swimlane = swimlane
+    sd.events = evts
+    sd.count = len(alignment.pairs)
+    sd.name = f"{swimlane.name}-xcorr-{dicoms_sd.name}"
+    sd.isotime_start = evts[0].isotime if evts[0] else None
+    sd.isotime_end = evts[-1].isotime if evts[-1] else None
+    sd.duration = (sd.isotime_end - sd.isotime_start).total_seconds() \
+        if evts[0] and evts[-1] else None
+    sd.offset = alignment.offset
+    sd.confidence = alignment.confidence
+    return sd
+
+
+# align events of all swimlanes with each DICOMs func series by
+# cross-correlation of event trains in global clock. Session offset
+# is found with all DICOMs series events, as gaps between series make
+# its peak unambiguous, then each series is aligned within two
+# intervals around it, or within swimlane synced tolerance around it
+# when series is not found there, e.g. DICOMs clock offset changes
+# between series. Each swimlane event is aligned at most once,
+# alignments with higher confidence and then smaller offset win.
+# Returns map of aligned series by swimlane name for each DICOMs series.
+def xcorr_model_series(cfg: DumpsConfig, model: DumpModel,
+                       min_confidence: float = 0.5) -> List[dict]:
+    res: List[dict] = [{} for _ in model.dicoms.series]
+    if not model.dicoms.series:
+        return res
+    ref_times: List[np.ndarray] = [
+        get_synced_times(model.dicoms.clock, dicoms_sd.events)
+        for dicoms_sd in model.dicoms.series]
+    for swiml in [model.birch, model.qrinfo, model.psychopy,
+                  model.reproevents]:
+        events: List[EventData] = swiml.events or \
+            [evt for sd in swiml.series for evt in sd.events]
+        if not events:
+            continue
+        times: np.ndarray = get_synced_times(swiml.clock, events)
+        tolerance: float = get_synced_tolerance(cfg, Swimlane.DICOMS,
+                                                swiml.name)
+        session: TrainAlignment = xcorr_align_events(
+            np.concatenate(ref_times), times, tolerance,
+            0.25 * (model.dicoms.series[0].interval or 2.0))
+        logger.info(f"XCorr dicoms -> {swiml.name}: "
+                    f"offset={session.offset}, "
+                    f"confidence={session.confidence:.3f}")
+        if session.offset is None:
+            continue
+        alignments: List[Tuple[int, TrainAlignment]] = []
+        for k_sd, dicoms_sd in enumerate(model.dicoms.series):
+            interval: float = dicoms_sd.interval or 2.0
+            for max_lag in sorted({2 * interval, max(2 * interval, tolerance)}):
+                alignment: TrainAlignment = xcorr_align_events(
+                    ref_times[k_sd] + session.offset, times, max_lag,
+                    0.25 * interval)
+                if alignment.confidence >= min_confidence:
+                    break
+            if alignment.offset is not None:
+                alignment.offset += session.offset
+            logger.info(f"XCorr {dicoms_sd.name} -> {swiml.name}: "
+                        f"offset={alignment.offset}, "
+                        f"confidence={alignment.confidence:.3f}, "
+                        f"pairs={len(alignment.pairs)}/{len(ref_times[k_sd])}")
+            logger.debug(f"  pairs: {[(dicoms_sd.events[i].id, events[j].id) for i, j in alignment.pairs]}")
+            if alignment.confidence >= min_confidence:
+                alignments.append((k_sd, alignment))
+
+        used: set = set()
+        for k_sd, alignment in sorted(
+                alignments, key=lambda a: (-a[1].confidence,
+                                           abs(a[1].offset))):
+            dicoms_sd: SeriesData = model.dicoms.series[k_sd]
+            indexes: set = {j for _, j in alignment.pairs}
+            if used & indexes:
+                logger.debug(f"XCorr {dicoms_sd.name} -> {swiml.name}: "
+                             f"skip, events already aligned")
+                continue
+            used |= indexes
+            res[k_sd][swiml.name] = build_aligned_series(
+                swiml, dicoms_sd, events, alignment)
+    return res
+
+
+# Iterate swimlane events from raw JSONL objects in a single pass,
+# when duration is not provided in dump, it's calculated as interval
+# to the next event, so each event is yielded with one event delay
+def iter_swimlane_events(swimlane: SwimlaneModel,
+                         objs: Iterable[dict]) -> Generator[EventData, None, None]:
+    prev_ed: EventData = None
+    for obj in objs:
         if swimlane.event_type and obj.get('type') != swimlane.event_type:
             logger.debug(f"Skip event object, type is not {swimlane.event_type}: {obj.get('id')}")
             continue
@@ -413,36 +836,32 @@ def build_swimlane_events(swimlane: SwimlaneModel):
             # logger.debug(f"Duration of {ed.id}: {v}")
             ed.duration = float(v)
         else:
-            if len(swimlane.events)>0:
-                prev_ed = swimlane.events[-1]
-                ed.duration = 0.0
-                #logger.debug(f"prev_ed: {prev_ed.isotime}")
-                #logger.debug(f"ed: {ed.isotime}")
+            ed.duration = 0.0
+            if prev_ed:
                 prev_ed.duration = (ed.isotime - prev_ed.isotime).total_seconds()
-            else:
-                ed.duration = 0.0
 
         ed.swimlane = swimlane
         ed.data = obj
-        swimlane.events.append(ed)
+        if prev_ed:
+            yield prev_ed
+        prev_ed = ed
+
+    if prev_ed:
+        yield prev_ed
 
 
-def build_model(session_id: str, path: str) -> DumpModel:
+# build model streaming each swimlane dump once, so only detected
+# series and their events are kept in memory rather than all dumps,
+# unless keep_events is specified
+def build_model(session_id: str, path: str,
+                keep_events: bool = False) -> DumpModel:
     m: DumpModel = DumpModel()
     m.session_id = session_id
 
-    # build swimlane data, events and map by id
-    for sl in m.swimlanes:
-        # first, load all JSONL data to memory
-        sl.data = parse_jsonl(get_dump_path(path, sl))
-        # build events data
-        build_swimlane_events(sl)
-        for evt in sl.events:
-            #logger.debug(f"Object: {evt.data}")
-            m.map_by_id[evt.id] = evt
-
-    # as second, detect possible series in each swimlane
-    m.dicoms.series = find_dicoms_func_series(m)
+    # as first, detect DICOMs func series
+    m.dicoms.series = find_dicoms_func_series(
+        m.dicoms, iter_swimlane_events(
+            m.dicoms, load_swimlane_objs(path, m.dicoms)))
 
     interval: float = m.dicoms.series[0].interval
     if interval > 2.5 or interval < 1.5:
@@ -450,8 +869,24 @@ def build_model(session_id: str, path: str) -> DumpModel:
         # logger.error(f"!!! Please check DICOMs series[0] data: {m.dicoms.series[0].data}")
         interval = 2.0
 
+    # as second, detect possible series in each swimlane
     for sl in chain([m.birch, m.qrinfo, m.psychopy, m.reproevents]):
-        sl.series = find_swimlane_series(sl, interval)
+        events: Iterable[EventData] = iter_swimlane_events(
+            sl, load_swimlane_objs(path, sl))
+        if keep_events:
+            sl.events = list(events)
+            events = sl.events
+        sl.series = find_swimlane_series(sl, interval, events)
+
+    # build series index once per swimlane
+    for sl in m.swimlanes:
+        sl.series_index = SeriesIndex(sl.series)
+
+    # build map by id for series events
+    for sl in m.swimlanes:
+        for sd in sl.series:
+            for evt in sd.events:
+                m.map_by_id[evt.id] = evt
 
     # dump short series info
     for sl in m.swimlanes:
@@ -480,7 +915,12 @@ def generate_marks(cfg: DumpsConfig, model: DumpModel):
 
     marks: List[MarkRecord] = []
     offset: dict = {}
-    for dicoms_sd in model.dicoms.series:
+    aligned: Optional[List[dict]] = None
+    if cfg.series_alignment == 'xcorr':
+        aligned = xcorr_model_series(cfg, model)
+    elif cfg.series_alignment != 'greedy':
+        aligned = align_model_series(cfg, model)
+    for k_sd, dicoms_sd in enumerate(model.dicoms.series):
         # generate start mark
         mark: MarkRecord = MarkRecord()
         mark.id = generate_id('mark')
@@ -496,14 +936,27 @@ def generate_marks(cfg: DumpsConfig, model: DumpModel):
         for swiml in [model.birch, model.qrinfo, model.psychopy,
                       model.reproevents]:
             #logger.debug(f"match with swiml={swiml.name}")
-            ref_sd: SeriesData = map_series.get(cfg.ref_swimlane) # Swimlane.BIRCH
-            #logger.debug(f"ref_sd={cfg.ref_swimlane}")
-            match_sd: SeriesData = match_series(cfg, ref_sd if ref_sd
-                                                else dicoms_sd,
-                                                swiml.series)
+            if aligned is not None:
+                match_sd: SeriesData = aligned[k_sd].get(swiml.name)
+            else:
+                ref_sd: SeriesData = map_series.get(cfg.ref_swimlane) # Swimlane.BIRCH
+                #logger.debug(f"ref_sd={cfg.ref_swimlane}")
+                match_sd: SeriesData = match_series(cfg, ref_sd if ref_sd
+                                                    else dicoms_sd,
+                                                    swiml.series,
+                                                    swiml.series_index)
             if match_sd:
                 map_series[swiml.name] = match_sd
                 logger.debug(f"store map_series[{swiml.name}] -> {match_sd.name}")
+            # first event can be missing in aligned series
+            if match_sd and match_sd.confidence is not None:
+                if mark.alignments is None:
+                    mark.alignments = {}
+                mark.alignments[swiml.name] = {
+                    "offset": match_sd.offset,
+                    "confidence": match_sd.confidence,
+                    "pairs": match_sd.count}
+            if match_sd and match_sd.events[0]:
                 mark.target_ids.append(match_sd.events[0].id)
                 setattr(mark, f"{swiml.name}_isotime", match_sd.isotime_start)
                 setattr(mark, f"{swiml.name}_duration", match_sd.duration)
@@ -529,6 +982,8 @@ def generate_marks(cfg: DumpsConfig, model: DumpModel):
             if i != last_i:
                 mark.dicoms_duration = dicoms_sd.events[i].duration
             for k, v in map_series.items():
+                if not v.events[i]:
+                    continue
                 mark.target_ids.append(v.events[i].id)
                 setattr(mark, f"{k}_isotime", v.events[i].isotime)
                 # skip duration for last item
@@ -549,6 +1004,8 @@ def generate_marks(cfg: DumpsConfig, model: DumpModel):
         #mark.dicoms_duration = None
         logger.debug(f"Mark: {mark}")
         for k, v in map_series.items():
+            if not v.events[-1]:
+                continue
             mark.target_ids.append(v.events[-1].id)
             setattr(mark, f"{k}_isotime", v.isotime_end)
             #setattr(mark, f"{k}_duration", None)
@@ -628,8 +1085,11 @@ def generate_marks(cfg: DumpsConfig, model: DumpModel):
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_marks.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -654,10 +1114,12 @@ def main(ctx, path: str, log_level):
     # load dumps config:
     cfg: DumpsConfig = do_config(path, _tmp_svc)
 
-    model: DumpModel = build_model(session_id, path_dumps)
+    model: DumpModel = build_model(session_id, path_dumps,
+                                   cfg.series_alignment == 'xcorr')
     #logger.debug(f"Model: {model}")
 
-    generate_marks(cfg, model)
+    with jsonl_output(output):
+        generate_marks(cfg, model)
     return 0
 
 
@@ -1,21 +1,25 @@
 #!/usr/bin/env python3
 import getpass
+import heapq
 import json
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 from typing import Tuple, Optional, List
 from collections import OrderedDict
 
 import click
 import logging
-import jsonlines
-import pandas as pd
 
 from repronim_dumps import DumpsConfig, do_config
 from repronim_timing import (TMapService, Clock, dump_jsonl,
                              find_study_range, generate_id,
-                             get_session_id, get_tmap_svc)
+                             get_session_id, get_tmap_svc, parse_isotime,
+                             seek_isotime, load_time_index, TimeIndex,
+                             LOG_TIME_SLACK,
+                             jsonl_output, get_dump_file, parse_jsonl_gen)
 
 # initialize the logger
 # Note: all logs goes to stderr
@@ -25,35 +29,68 @@ logger.setLevel(logging.DEBUG)
 #logger.debug(f"name={__name__}")
 
 
-def dump_psychopy(session_id: str, logpath: str, range_start: datetime,
-                  range_end: datetime, qrinfo_map: dict) -> None:
-    with (jsonlines.open(logpath) as reader):
-        for obj in reader:
-            time_str = obj.get('time_formatted')
-            if time_str:
-                time_dt = pd.to_datetime(time_str).replace(tzinfo=None)
-                evt: str = obj.get('event')
-                keys: str = obj.get('keys')
-                key0: str = keys[0] if keys and len(keys) > 0 else None
-                logger.debug(f"Time: {time_dt}, event: {evt}, key0: {key0}")
-
-                if range_start <= time_dt <= range_end and evt=='trigger' and key0=='5':
-                    obj['id'] = None
-                    obj['session_id'] = session_id
-                    obj['isotime'] = time_dt.isoformat()
-                    if obj.get('event') == 'trigger':
-                        keys_time = pd.to_datetime(
-                            obj.get('keys_time_str')
-                        ).replace(tzinfo=None)
-                        obj['isotime'] = keys_time.isoformat()
-                    obj['qrinfo_id'] = None
-                    key = get_qrinfo_map_key(obj)
-                    if key in qrinfo_map:
-                        obj['qrinfo_id'] = qrinfo_map[key].get('id')
-                    # dump_jsonl(obj)
-                    yield obj
-                else:
-                    logger.debug(f"Skip, out of study range: {obj}")
+# parse psychopy log line time_formatted, None for lines without it
+def get_psychopy_line_isotime(line: bytes) -> Optional[datetime]:
+    try:
+        return parse_isotime(json.loads(line).get('time_formatted'),
+                             tz_convert=False)
+    except Exception:
+        return None
+
+
+# read psychopy log lines, only study range lines with a margin for
+# timestamps jitter are read when sidecar time index exists
+def read_psychopy_lines(logpath: str, range_start: datetime,
+                        range_end: datetime) -> List[bytes]:
+    index: Optional[TimeIndex] = load_time_index(logpath)
+    with open(logpath, 'rb') as f:
+        if not index:
+            return f.read().splitlines()
+        start: int = seek_isotime(f, range_start - LOG_TIME_SLACK,
+                                  get_psychopy_line_isotime,
+                                  index=index)
+        end: int = seek_isotime(f, range_end + LOG_TIME_SLACK,
+                                get_psychopy_line_isotime,
+                                side='right', lo=start, index=index)
+        f.seek(start)
+        return f.read(end - start).splitlines()
+
+
+def get_psychopy_isotime(obj: dict) -> str:
+    return obj.get('isotime')
+
+
+# load study range trigger events from psychopy log sorted by isotime,
+# lines are filtered by event and keys before any timestamp parsing
+def load_psychopy_triggers(session_id: str, logpath: str,
+                           range_start: datetime,
+                           range_end: datetime) -> List[dict]:
+    lst: List[dict] = []
+    skipped: int = 0
+    for line in read_psychopy_lines(logpath, range_start, range_end):
+        # cheap check before JSON decoding
+        if b'"trigger"' not in line:
+            continue
+        obj: dict = json.loads(line)
+        keys: str = obj.get('keys')
+        key0: str = keys[0] if keys and len(keys) > 0 else None
+        time_str: str = obj.get('time_formatted')
+        if obj.get('event') != 'trigger' or key0 != '5' or not time_str:
+            continue
+
+        time_dt = parse_isotime(time_str, tz_convert=False)
+        if not range_start <= time_dt <= range_end:
+            skipped += 1
+            continue
+        obj['id'] = None
+        obj['session_id'] = session_id
+        keys_time = parse_isotime(obj.get('keys_time_str'), tz_convert=False)
+        obj['isotime'] = keys_time.isoformat()
+        obj['qrinfo_id'] = None
+        lst.append(obj)
+    logger.debug(f"  {os.path.basename(logpath)} : {len(lst)} triggers, "
+                 f"{skipped} out of study range")
+    return sorted(lst, key=get_psychopy_isotime)
 
 
 def find_psychopy_all_logfiles(psychopy_path: str) -> List[str]:
@@ -64,12 +101,11 @@ def find_psychopy_all_logfiles(psychopy_path: str) -> List[str]:
 def find_psychopy_logfiles(qrinfo_path: str) -> List[str]:
     logfn_ordered_dict = OrderedDict()
 
-    with jsonlines.open(qrinfo_path) as reader:
-        for obj in reader:
-            if obj.get('type') == 'QrRecord':
-                logfn = obj.get('data', {}).get('logfn')
-                if logfn and logfn not in logfn_ordered_dict:
-                    logfn_ordered_dict[logfn] = None
+    for obj in parse_jsonl_gen(qrinfo_path, types=['QrRecord'],
+                               fields=['data']):
+        logfn = obj.get('data', {}).get('logfn')
+        if logfn and logfn not in logfn_ordered_dict:
+            logfn_ordered_dict[logfn] = None
 
     return list(logfn_ordered_dict.keys())
 
@@ -81,11 +117,9 @@ def get_qrinfo_map_key(obj: dict) -> str:
 # Build QRInfo map, where key if log file name + keys_time_str
 def load_qrinfo_map(qrinfo_path: str) -> dict:
     m = {}
-    with jsonlines.open(qrinfo_path) as reader:
-        for obj in reader:
-            if obj.get('type') == 'QrRecord':
-                key = get_qrinfo_map_key(obj.get('data'))
-                m[key] = obj
+    for obj in parse_jsonl_gen(qrinfo_path, types=['QrRecord']):
+        key = get_qrinfo_map_key(obj.get('data'))
+        m[key] = obj
     return m
 
 
@@ -96,8 +130,14 @@ def load_qrinfo_map(qrinfo_path: str) -> dict:
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('--jobs', default=1, type=int,
+              help='Number of worker processes used to read psychopy '
+                   'log files, 1 (default) to read serially')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, jobs: int, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_psychopy.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -119,7 +159,7 @@ def main(ctx, path: str, log_level):
         logger.error(f"Dumps path does not exist: {dumps_path}")
         return 1
 
-    dump_dicoms_path = os.path.join(dumps_path, "dump_dicoms.jsonl")
+    dump_dicoms_path = get_dump_file(dumps_path, "dump_dicoms")
     logger.info(f"DICOMS dump   : {dump_dicoms_path}")
 
     if not os.path.exists(dump_dicoms_path):
@@ -133,7 +173,7 @@ def main(ctx, path: str, log_level):
         logger.error(f"Psychopy path does not exist: {psychopy_path}")
         return 1
 
-    qrinfo_path: str = os.path.join(dumps_path, "dump_qrinfo.jsonl")
+    qrinfo_path: str = get_dump_file(dumps_path, "dump_qrinfo")
     logger.info(f"QRInfo path   : {qrinfo_path}")
 
     if not os.path.exists(qrinfo_path):
@@ -166,23 +206,36 @@ def main(ctx, path: str, log_level):
     lst_logfiles = find_psychopy_all_logfiles(psychopy_path) # use all log files
     logger.info(f"Psychopy log files: {lst_logfiles}")
 
-    # dump the psychopy log files filtered by the study range
-    lst: List[dict] = []
-    for logfn in lst_logfiles:
-        logpath = os.path.join(psychopy_path, logfn)
+    # load the psychopy log files filtered by the study range, files
+    # are processed concurrently by jobs worker processes
+    logpaths: List[str] = [os.path.join(psychopy_path, logfn)
+                           for logfn in lst_logfiles]
+    for logpath in logpaths:
         logger.info(f"Psychopy log file: {logpath}")
-        for obj in dump_psychopy(session_id, logpath,
-                      range_start, range_end,
-                      qrinfo_map):
-            lst.append(obj)
-
-    # sort list by isotime
-    lst = sorted(lst, key=lambda x: x.get('isotime'))
-
-    # generate IDs and dump
-    for obj in lst:
-        obj['id'] = generate_id('psychopy')
-        dump_jsonl(obj)
+    executor: Optional[ProcessPoolExecutor] = None
+    try:
+        if jobs > 1 and len(logpaths) > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = executor.map(load_psychopy_triggers,
+                                   repeat(session_id), logpaths,
+                                   repeat(range_start), repeat(range_end))
+        else:
+            results = map(load_psychopy_triggers,
+                          repeat(session_id), logpaths,
+                          repeat(range_start), repeat(range_end))
+        lst_triggers: List[List[dict]] = list(results)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
+    # merge sorted file events by isotime, generate IDs and dump
+    with jsonl_output(output):
+        for obj in heapq.merge(*lst_triggers, key=get_psychopy_isotime):
+            key = get_qrinfo_map_key(obj)
+            if key in qrinfo_map:
+                obj['qrinfo_id'] = qrinfo_map[key].get('id')
+            obj['id'] = generate_id('psychopy')
+            dump_jsonl(obj)
 
 
     return 0
@@ -2,20 +2,25 @@
 import getpass
 import json
 import os
+import re
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
+from itertools import repeat
 from typing import Tuple, Optional, List
 from collections import OrderedDict
 
 import click
 import logging
-import jsonlines
+import numpy as np
 import pandas as pd
 
 from repronim_dumps import DumpsConfig, do_config
 from repronim_timing import (TMapService, Clock, dump_jsonl,
                              find_study_range, generate_id,
-                             get_session_id, get_tmap_svc)
+                             get_session_id, get_tmap_svc, parse_isotimes,
+                             jsonl_output, get_dump_file, JsonlReader,
+                             get_jsonl_line_type)
 
 # initialize the logger
 # Note: all logs goes to stderr
@@ -25,55 +30,92 @@ logger.setLevel(logging.DEBUG)
 #logger.debug(f"name={__name__}")
 
 
-def dump_qrinfo_file(session_id: str, path: str, range_start: datetime,
-                    range_end: datetime):
-    logger.debug(f"Processing QR : {path}")
-    lst = []
-    psum = None
-    with (jsonlines.open(path) as reader):
-        for obj in reader:
+# video info fields of ParseSummary added to each QR record
+VIDEO_FIELDS: List[str] = ['video_file_name', 'video_isotime_start',
+                           'video_isotime_end', 'video_frame_width',
+                           'video_frame_height', 'video_frame_rate']
+
+# QR record start time, extracted without decoding of the record
+_re_isotime_start: re.Pattern = re.compile(rb'"isotime_start"\s*:\s*"([^"\\]*)"')
+
+
+# load parse summary and QR records within study range from
+# *.qrinfo.jsonl file, start times of all QR records are parsed at
+# once, and only records within study range are decoded. Returns
+# summary, records and number of skipped records.
+def load_qrinfo_file(path: str, range_start: datetime,
+                     range_end: datetime) -> Tuple[Optional[dict], List[dict], int]:
+    psum: Optional[dict] = None
+    # raw lines or already decoded QR records
+    records: List = []
+    isotimes: List[str] = []
+    with JsonlReader(path) as reader:
+        for line in reader.iter_lines():
+            m = _re_isotime_start.search(line) \
+                if get_jsonl_line_type(line) == 'QrRecord' else None
+            if m:
+                records.append(line)
+                isotimes.append(m.group(1).decode('utf-8'))
+                continue
+            obj: dict = json.loads(line)
             if obj.get('type') == 'QrRecord':
-                lst.append(obj)
+                records.append(obj)
+                isotimes.append(obj.get('isotime_start'))
             elif obj.get('type') == 'ParseSummary':
                 psum = obj
             else:
                 logger.debug(f"Skipping {obj}")
 
-    if not psum:
-        logger.error(f"Missing ParseSummary in {path}")
-        return
-
-    for obj in lst:
-        isotime_start = pd.to_datetime(obj['isotime_start']
-                                       ).replace(tzinfo=None)
-        if range_start <= isotime_start <= range_end:
-            # make flat, add videos info for info purposes
-            obj['id'] = generate_id('qrinfo')
-            obj['session_id'] = session_id
-            obj['video_file_name'] = psum.get('video_file_name')
-            obj['video_isotime_start'] = psum.get('video_isotime_start')
-            obj['video_isotime_end'] = psum.get('video_isotime_end')
-            obj['video_frame_width'] = psum.get('video_frame_width')
-            obj['video_frame_height'] = psum.get('video_frame_height')
-            obj['video_frame_rate'] = psum.get('video_frame_rate')
-            dump_jsonl(obj)
-        else:
-            logger.debug(f"Skip, out of study datetime range: {obj}")
+    isotimes_start: pd.Series = parse_isotimes(isotimes, tz_convert=False)
+    mask: np.ndarray = ((isotimes_start >= range_start) &
+                        (isotimes_start <= range_end)).to_numpy(dtype=bool)
+    lst: List[dict] = [json.loads(r) if isinstance(r, bytes) else r
+                       for r, selected in zip(records, mask) if selected]
+    return psum, lst, len(records) - len(lst)
 
 
+# dump QR records of all parsed videos, files are loaded concurrently
+# by jobs worker processes and dumped in sorted files order
 def dump_qrinfo_all(session_id: str, path: str, range_start: datetime,
-                    range_end: datetime):
+                    range_end: datetime, jobs: int = 1):
     logger.debug(f"Reading parsed video QRs directory: {path}")
+    filepaths: List[str] = []
     for name in sorted(os.listdir(path)):
         # check if file is *.dcm
         if name.endswith('.qrinfo.jsonl'):
-            filepath = os.path.join(path, name)
-            logger.debug(f"  {name}")
-            dump_qrinfo_file(session_id, filepath,
-                             range_start, range_end)
+            filepaths.append(os.path.join(path, name))
         else:
             logger.debug(f"  Skipping {name}")
 
+    executor: Optional[ProcessPoolExecutor] = None
+    try:
+        if jobs > 1 and len(filepaths) > 1:
+            executor = ProcessPoolExecutor(max_workers=jobs)
+            results = executor.map(load_qrinfo_file, filepaths,
+                                   repeat(range_start), repeat(range_end))
+        else:
+            results = map(load_qrinfo_file, filepaths,
+                          repeat(range_start), repeat(range_end))
+
+        for filepath, (psum, lst, skipped) in zip(filepaths, results):
+            logger.debug(f"Processing QR : {filepath}")
+            if not psum:
+                logger.error(f"Missing ParseSummary in {filepath}")
+                continue
+            logger.debug(f"  {len(lst)} QR records, {skipped} out of "
+                         f"study datetime range")
+            # make flat, add videos info for info purposes, the same
+            # for all file records
+            video: dict = {k: psum.get(k) for k in VIDEO_FIELDS}
+            for obj in lst:
+                obj['id'] = generate_id('qrinfo')
+                obj['session_id'] = session_id
+                obj.update(video)
+                dump_jsonl(obj)
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+
 
 @click.command(help='Dump qrinfo data tool.')
 @click.argument('path', type=click.Path(exists=True))
@@ -82,8 +124,14 @@ def dump_qrinfo_all(session_id: str, path: str, range_start: datetime,
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('--jobs', default=1, type=int,
+              help='Number of worker processes used to load parsed '
+                   'video QR files, 1 (default) to load serially')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, jobs: int, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_qrinfo.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -106,7 +154,7 @@ def main(ctx, path: str, log_level):
         logger.error(f"Dumps path does not exist: {dumps_path}")
         return 1
 
-    dump_dicoms_path = os.path.join(dumps_path, "dump_dicoms.jsonl")
+    dump_dicoms_path = get_dump_file(dumps_path, "dump_dicoms")
     logger.info(f"DICOMS dump   : {dump_dicoms_path}")
 
     if not os.path.exists(dump_dicoms_path):
@@ -136,7 +184,9 @@ def main(ctx, path: str, log_level):
     logger.info(f"              : qrinfo {range_start} - {range_end}")
 
 
-    dump_qrinfo_all(session_id, parsed_videos_path, range_start, range_end)
+    with jsonl_output(output):
+        dump_qrinfo_all(session_id, parsed_videos_path,
+                        range_start, range_end, jobs)
 
     return 0
 
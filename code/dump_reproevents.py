@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
+import csv
 import getpass
+import io
 import json
 import os
 import sys
 from datetime import datetime
 from pydantic import BaseModel, Field
-from typing import Tuple, Optional, List
+from typing import Tuple, Optional, List, Callable, Dict
 from collections import OrderedDict
 
 import click
@@ -15,7 +17,10 @@ import pandas as pd
 
 from repronim_timing import (TMapService, Clock, dump_jsonl,
                              find_study_range, generate_id,
-                             get_session_id, get_tmap_svc, parse_isotime)
+                             get_session_id, get_tmap_svc, parse_isotime,
+                             parse_isotimes, seek_isotime,
+                             load_time_index, TimeIndex, LOG_TIME_SLACK,
+                             jsonl_output, get_dump_file)
 
 from repronim_dumps import ReproeventsRecord, DumpsConfig, do_config
 
@@ -33,11 +38,14 @@ def get_reproevents_isotime(obj: dict) -> datetime:
     return parse_isotime(iso_time_str)
 
 
-# Function to convert a reproevents CSV row to ReproeventsRecord
-def row_to_model(row, session_id:str, file_name: str):
-    data_dict = row.to_dict()
+# Function to convert a reproevents CSV row to ReproeventsRecord,
+# isotime can be specified when already parsed
+def row_to_model(row, session_id:str, file_name: str,
+                 isotime: datetime = None):
+    data_dict = row if isinstance(row, dict) else row.to_dict()
     return ReproeventsRecord(
-        isotime=get_reproevents_isotime(row),
+        isotime=isotime if isotime is not None
+        else get_reproevents_isotime(data_dict),
         duration=0.0,
         state_duration=0.0,
         session_id=session_id,
@@ -48,45 +56,112 @@ def row_to_model(row, session_id:str, file_name: str):
         data=data_dict  # Put all as 'data' dictionary
     )
 
+
+# select reproevents rows in study range and calculate durations in
+# columnar way, returns frame with only rows to be dumped
+def select_revents(df: pd.DataFrame, range_start: datetime,
+                   range_end: datetime) -> pd.DataFrame:
+    isotime: pd.Series = parse_isotimes(df['client_time_iso'])
+    # stop processing after too many records after the range end
+    after_end: pd.Series = isotime > range_end
+    processed = (after_end.cumsum() - after_end) <= 100
+    if not processed.all():
+        logger.debug(f"Skip reproevents processing, too many records after the range end")
+    in_range = processed & (range_start <= isotime) & (isotime <= range_end)
+    logger.debug(f"Skip reproevents, out of study datetime range: "
+                 f"{int(processed.sum() - in_range.sum())} records")
+
+    df = df.loc[in_range].assign(isotime=isotime[in_range])
+    # blank or malformed state is not 1
+    is_on = pd.to_numeric(df['state'], errors='coerce') == 1
+    logger.debug(f"Skip reproevents, state is not 1: "
+                 f"{int((~is_on).sum())} records")
+    server_time = df['server_time'].astype(float)
+
+    # duration till the next state 1 event
+    on_time = server_time[is_on]
+    duration = (on_time.shift(-1) - on_time).fillna(0.0)
+
+    # state duration till the last state 0 event before the next one
+    group = is_on.cumsum()
+    off_mask = ~is_on & (group > 0)
+    off_time = server_time[off_mask].groupby(group[off_mask]).last()
+    state_duration = (pd.Series(off_time.reindex(group[is_on]).to_numpy(),
+                                index=on_time.index) - on_time).fillna(0.0)
+
+    return df.loc[is_on].assign(duration=duration,
+                                state_duration=state_duration)
+
+
+# build reproevents CSV line isotime parser for the file header,
+# None when there is no client_time_iso column
+def get_revents_line_isotime_func(
+        header: bytes) -> Optional[Callable[[bytes], Optional[datetime]]]:
+    columns: List[str] = next(csv.reader([header.decode('utf-8')]), [])
+    if 'client_time_iso' not in columns:
+        return None
+    col: int = columns.index('client_time_iso')
+
+    def get_time(line: bytes) -> Optional[datetime]:
+        try:
+            row = next(csv.reader([line.decode('utf-8')]))
+            return get_reproevents_isotime({'client_time_iso': row[col]})
+        except Exception:
+            return None
+    return get_time
+
+
+# get reproevents CSV columns dtypes inferred from the whole file,
+# e.g. to be stored in sidecar time index
+def get_revents_dtypes(path: str) -> Dict[str, str]:
+    return {name: str(dtype)
+            for name, dtype in pd.read_csv(path).dtypes.items()}
+
+
+# read time-ordered reproevents CSV file rows in study range only,
+# located with binary search by client_time_iso column and sidecar
+# time index. Rows span is parsed with whole file dtypes stored in
+# index, as dtypes inferred from the span only may differ (e.g. int
+# column with NaN values out of range), so the whole file is read
+# when there is no up-to-date index with dtypes.
+def read_revents_csv(path: str, range_start: datetime,
+                     range_end: datetime) -> pd.DataFrame:
+    with open(path, 'rb') as f:
+        header: bytes = f.readline()
+        get_time = get_revents_line_isotime_func(header)
+        index: Optional[TimeIndex] = load_time_index(path)
+        if not get_time or not index or not index.dtypes:
+            return pd.read_csv(path)
+
+        start: int = seek_isotime(f, range_start - LOG_TIME_SLACK,
+                                  get_time, lo=f.tell(), index=index)
+        end: int = seek_isotime(f, range_end + LOG_TIME_SLACK, get_time,
+                                side='right', lo=start, index=index)
+        logger.debug(f"Seek offsets : {start} - {end}")
+        f.seek(start)
+        data: bytes = f.read(end - start)
+    return pd.read_csv(io.BytesIO(header + data), dtype=index.dtypes)
+
+
 def dump_revents_file(session_id: str, path: str, range_start: datetime,
                     range_end: datetime):
     logger.debug(f"Processing reproevents : {path}")
-    # Read CSV file into a pandas DataFrame
-    df = pd.read_csv(path)
+    # Read CSV file rows in study range into a pandas DataFrame
+    df = read_revents_csv(path, range_start, range_end)
     file_name: str = os.path.basename(path)
-    lst: List[ReproeventsRecord] = []
-
-    c_after_end: int = 0
-    for _, row in df.iterrows():
-        if c_after_end>100:
-            logger.debug(f"Skip reproevents processing, too many records after the range end")
-            break
-        obj = row_to_model(row, session_id, file_name)
-        if range_start <= obj.isotime <= range_end:
-            if obj.state == 1:
-                # calc duration for prev item
-                if len(lst) > 0:
-                    prev_obj = lst[-1]
-                    prev_obj.duration = obj.server_time - prev_obj.server_time
-
-                obj.id = generate_id("reproevents")
-                lst.append(obj)
-                #dump_jsonl(obj)
-            else:
-                logger.debug(f"Skip reproevents, state is not 1: {obj}")
-                # calc state_duration for prev item
-                if len(lst) > 0:
-                    prev_obj = lst[-1]
-                    prev_obj.state_duration = obj.server_time - prev_obj.server_time
-        else:
-            logger.debug(f"Skip reproevents, out of study datetime range: {obj}")
-            if obj.isotime > range_end:
-                c_after_end += 1
-
-    # dump all records to as jsonl
-    for obj in lst:
+    sel: pd.DataFrame = select_revents(df, range_start, range_end)
+
+    # materialize and dump only selected records as jsonl
+    for row, isotime, duration, state_duration in zip(
+            df.loc[sel.index].to_dict('records'), sel['isotime'],
+            sel['duration'], sel['state_duration']):
+        obj = row_to_model(row, session_id, file_name, isotime)
+        obj.duration = float(duration)
+        obj.state_duration = float(state_duration)
+        obj.id = generate_id("reproevents")
         dump_jsonl(obj)
 
+
 def dump_revents_all(session_id: str, path: str, range_start: datetime,
                     range_end: datetime):
     logger.debug(f"Reading reproevent dir : {path}")
@@ -108,8 +183,11 @@ def dump_revents_all(session_id: str, path: str, range_start: datetime,
                                  'WARNING', 'ERROR',
                                  'CRITICAL']),
               help='Set the logging level')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level):
+def main(ctx, path: str, log_level, output: str):
     logger.setLevel(log_level)
     logger.debug("dump_reproevents.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -132,7 +210,7 @@ def main(ctx, path: str, log_level):
         logger.error(f"Dumps path does not exist: {dumps_path}")
         return 1
 
-    dump_dicoms_path = os.path.join(dumps_path, "dump_dicoms.jsonl")
+    dump_dicoms_path = get_dump_file(dumps_path, "dump_dicoms")
     logger.info(f"DICOMS dump   : {dump_dicoms_path}")
 
     if not os.path.exists(dump_dicoms_path):
@@ -161,8 +239,9 @@ def main(ctx, path: str, log_level):
                                        range_end)
     logger.info(f"              : reproevents {range_start} - {range_end}")
 
-    dump_revents_all(session_id, revents_path,
-                     range_start, range_end)
+    with jsonl_output(output):
+        dump_revents_all(session_id, revents_path,
+                         range_start, range_end)
     return 0
 
 
@@ -13,7 +13,8 @@ import logging
 
 from repronim_dumps import DumpsConfig, do_config
 from repronim_timing import (TMapRecord, parse_jsonl, get_session_id, Clock,
-                             parse_isotime, dump_jsonl, dump_csv, get_tmap_svc)
+                             parse_isotime, dump_jsonl, dump_csv, get_tmap_svc,
+                             jsonl_output, get_dump_file)
 
 
 # initialize the logger
@@ -32,11 +33,14 @@ def _check_mark(cfg: DumpsConfig, obj, swimlane: str) -> bool:
         return True
 
 
-def find_full_marks(cfg: DumpsConfig, marks: List) -> List[dict]:
+def find_full_marks(cfg: DumpsConfig, marks: List,
+                    scans: bool = False) -> List[dict]:
+    kinds: List[str] = ['Func series start', 'Func series scan'] if scans \
+        else ['Func series start']
     lst: List[dict] = []
     for obj in marks:
         if (obj.get('type')=='MarkRecord' and
-            obj.get('kind')=='Func series start' and
+            obj.get('kind') in kinds and
             _check_mark(cfg, obj, 'dicoms') and
             _check_mark(cfg, obj, 'birch') and
             _check_mark(cfg, obj, 'qrinfo') and
@@ -112,12 +116,14 @@ def get_dump_id(prefix: str, target_ids: List[str]) -> Optional[str]:
 
 
 def generate_tmap(cfg: DumpsConfig, session_id: str, path_marks: str,
-                  extended: bool, format: str) -> int:
+                  extended: bool, format: str,
+                  output: Optional[str] = None,
+                  scans: bool = False) -> int:
     logger.debug(f"generate_tmap({path_marks})")
 
     marks: List = parse_jsonl(path_marks)
     # use partial or full marks depending on the mode
-    fmarks = find_partial_marks(marks) if extended else find_full_marks(cfg, marks)
+    fmarks = find_partial_marks(marks) if extended else find_full_marks(cfg, marks, scans)
     if len(fmarks)<=0:
         logger.error(f"Full/completed mark not found in {path_marks}")
         return 1
@@ -164,11 +170,11 @@ def generate_tmap(cfg: DumpsConfig, session_id: str, path_marks: str,
         tmr.reproevents_duration = calc_duration(cfg, fm, Clock.REPROEVENTS, ref_duration)
         tmr.reproevents_deviation = calc_deviation(fm, 'reproevents_duration', ref_duration)
         tmap.append(tmr)
-        if format == 'jsonl':
+        if format in ('jsonl', 'parquet'):
             dump_jsonl(tmr)
 
     if format == 'csv':
-        dump_csv(tmap)
+        dump_csv(tmap, output)
     return 0
 
 
@@ -180,14 +186,21 @@ def generate_tmap(cfg: DumpsConfig, session_id: str, path_marks: str,
                                  'CRITICAL']),
               help='Set the logging level')
 @click.option('-f', '--format', default='JSONL',
-              type=click.Choice(['JSONL', 'CSV']),
+              type=click.Choice(['JSONL', 'CSV', 'PARQUET']),
               help='Set the output format')
 @click.option('-e', '--extended', is_flag=True,
               help='Enable extended mode for tmap, in this mode '
                    'will be generated partial tmap entries, when not '
                    'all clocks are available')
+@click.option('-s', '--scans', is_flag=True,
+              help='Include full per-scan marks of func series, used '
+                   'by tmap service to fit clocks drift model')
+@click.option('-o', '--output', type=click.Path(),
+              help='Output file path, stdout by default, Parquet '
+                   'format is used for *.parquet file')
 @click.pass_context
-def main(ctx, path: str, log_level, extended, format):
+def main(ctx, path: str, log_level, extended, format, scans: bool,
+         output: str):
     logger.setLevel(log_level)
     logger.debug("dump_tmap.py tool")
     logger.info(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
@@ -209,7 +222,7 @@ def main(ctx, path: str, log_level, extended, format):
         logger.error(f"Session timing-dumps path does not exist: {path_dumps}")
         return 1
 
-    path_marks: str = os.path.join(path_dumps, "dump_marks.jsonl")
+    path_marks: str = get_dump_file(path_dumps, "dump_marks")
     if not os.path.exists(path_marks):
         logger.error(f"Dump marks path does not exist: {path_marks}")
         return 1
@@ -220,7 +233,11 @@ def main(ctx, path: str, log_level, extended, format):
     # load dumps config:
     cfg: DumpsConfig = do_config(path, _tmp_svc)
 
-    return generate_tmap(cfg, session_id, path_marks, extended, format)
+    # Parquet output is also selected by *.parquet output file
+    with jsonl_output(output if format != 'csv' else None,
+                      'parquet' if format == 'parquet' else None):
+        return generate_tmap(cfg, session_id, path_marks, extended, format,
+                             output, scans)
 
 
 if __name__ == "__main__":
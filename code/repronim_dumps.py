@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Tuple, Optional, List, Set
+from typing import Tuple, Optional, List, Set, Literal
 from pydantic import BaseModel, Field
 import yaml
 import os
@@ -29,6 +29,13 @@ class DumpsConfig(BaseModel):
     skip_swimlanes: Optional[Set[str]] = Field(set(), description="List of swimlanes to "
                                                                "be skipped when calculating "
                                                                "tmap.")
+    series_alignment: Optional[Literal['optimal', 'greedy', 'xcorr']] = Field(
+        "optimal", description="Swimlanes series alignment mode, 'optimal' "
+                               "to align all series one-to-one in time "
+                               "order, 'greedy' to match each DICOMs series "
+                               "separately, or 'xcorr' to cross-correlate "
+                               "event trains tolerating dropped or extra "
+                               "events.")
 
 
 ######################################################################
@@ -109,6 +116,14 @@ class SeriesRecord(BaseModel):
                                                         "series in seconds")
 
 
+# Define model for the dump file stamp, saved in a summary to check it
+# still describes the dump
+class DumpStampRecord(BaseModel):
+    type: Optional[str] = Field("DumpStampRecord", description="JSON record type/class")
+    size: int = Field(..., description="Dump file size")
+    mtime_ns: int = Field(..., description="Dump file mtime in nanoseconds")
+
+
 # Pydantic model for reproevents record
 class ReproeventsRecord(BaseModel):
     type: Optional[str] = Field("ReproeventsRecord", description="JSON record type/class")
@@ -168,6 +183,12 @@ class MarkRecord(BaseModel):
                                                                      "time in ISO format")
     reproevents_duration: Optional[float] = Field(None, description="Reproevents series duration "
                                                                     "in seconds")
+    alignments: Optional[dict] = Field(None, description="Cross-correlation alignment "
+                                                         "of swimlanes series with "
+                                                         "DICOMs series by swimlane "
+                                                         "name: offset in seconds, "
+                                                         "confidence and matched "
+                                                         "events count (pairs)")
 
 ######################################################################
 # Dumps config implementation
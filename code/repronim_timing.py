@@ -1,44 +1,378 @@
+import bisect
+import copy
 import json
+import mmap
+import os
+import re
 import sys
+from contextlib import contextmanager
 from enum import Enum
 from pathlib import Path
 
 from pydantic import BaseModel, Field
-from datetime import datetime
-from typing import Optional, List, Generator, Tuple
-import jsonlines
+import pydantic_core
+from datetime import datetime, timedelta
+from typing import (Optional, List, Generator, Tuple, Sequence, Iterable,
+                    BinaryIO, Callable, Dict)
+from zoneinfo import ZoneInfo
+import numpy as np
 import pandas as pd
 import logging
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.DEBUG)
 
+# timezone implicitly used by isotime format
+_tz_local: ZoneInfo = ZoneInfo('America/New_York')
+# timestamp resolution produced by pd.to_datetime for isotime strings,
+# depends on pandas version
+_isotime_unit: str = pd.to_datetime("2000-01-01T00:00:00.000001").unit
+# sub-microsecond fraction, truncated by datetime.fromisoformat
+_re_sub_us: re.Pattern = re.compile(r'\.\d{7,}')
+# time-ordered file span to be scanned linearly in bisect_isotime
+_bisect_block_size: int = 16 * 1024
+# margin around study range used to seek and stop processing of
+# time-ordered logs, as their timestamps may jitter, e.g. birch
+# iso_time up to ~0.05 sec
+LOG_TIME_SLACK: timedelta = timedelta(seconds=1)
+# clock drift model fitting: offset jump between sequential marks
+# larger than step threshold plus max drift rate by time between them
+# is considered as clock step. Step threshold is estimated per clock
+# from offset changes between sequential marks of the same session,
+# as clocks jitter differently, e.g. DICOMs offsets of func series
+# scans jitter up to ~0.04 sec but jump 0.06-0.9 sec between series,
+# so changes over step sigmas of robust (MAD) sigma are steps, but
+# threshold is not less than step tolerance. Segment drift rate
+# larger than max one is considered as jitter rather than drift
+_drift_step_tolerance: float = 0.05
+_drift_step_sigmas: float = 3.5
+_drift_max_rate: float = 1e-4
+# min time between marks in seconds to estimate drift rate, as
+# shorter spans are dominated by timestamps jitter, and min number of
+# marks in segment to fit its drift rate, otherwise segment marks
+# keep recorded offsets, and DICOMs ones use periods deviation
+_drift_min_span: float = 240.0
+_drift_min_marks: int = 5
+# max marks per segment used to estimate drift rate
+_drift_max_points: int = 1000
+# max time in seconds drift is extrapolated from the mark, e.g. marks
+# of previous session are used before the first mark of session
+_drift_max_extrapolation: float = 3600.0
+
 # placeholder for common timing code in ReproNim projects
 
 # common functions
 
-def dump_csv(lst: List):
+def dump_csv(lst: List, path: Optional[str] = None):
     # Convert the list of Pydantic models or objects to a DataFrame
     df = pd.DataFrame([obj.dict() for obj in lst])
-    # Print the DataFrame as CSV to stdout
-    df.to_csv(sys.stdout, index=False)
+    # Print the DataFrame as CSV to stdout or file
+    df.to_csv(path if path else sys.stdout, index=False)
+
+
+# the same as json.dumps(obj, ensure_ascii=False)
+_json_encoder: json.JSONEncoder = json.JSONEncoder(ensure_ascii=False)
+
+
+def to_jsonl(obj) -> str:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump_json()
+    return _json_encoder.encode(obj)
+
+
+# get record in the same form as decoded from its JSONL line
+def to_json_record(obj) -> dict:
+    if isinstance(obj, BaseModel):
+        return obj.model_dump(mode='json')
+    return copy.deepcopy(obj)
+
+
+# dumps records written by sinks to files, keyed by absolute path, so
+# stages running in the same process (e.g. run_timing_dumps.py) pass
+# records to dependent stages in memory. Each entry keeps file size
+# and mtime, so records are used only while the file is not changed.
+_dump_records: dict = {}
+# whether sinks keep written records in _dump_records
+_dump_handoff: bool = False
+
+
+# keep records of all dumps written to files within the block in
+# memory, so parse_jsonl_gen doesn't read them again
+@contextmanager
+def dump_handoff() -> Generator:
+    global _dump_handoff
+    prev: bool = _dump_handoff
+    _dump_handoff = True
+    try:
+        yield
+    finally:
+        _dump_handoff = prev
+
+
+def register_dump_records(path: str, records: List[dict]):
+    st = os.stat(path)
+    _dump_records[os.path.abspath(path)] = (st.st_size, st.st_mtime_ns,
+                                            records)
+
+
+# get in-memory records of dump file, None when there are no records
+# or the file was changed after they were written
+def get_dump_records(path: str) -> Optional[List[dict]]:
+    entry = _dump_records.get(os.path.abspath(path))
+    if entry is None:
+        return None
+    size, mtime_ns, records = entry
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    if st.st_size != size or st.st_mtime_ns != mtime_ns:
+        return None
+    return records
+
+
+# buffered JSONL output sink, records are serialized as soon as
+# written (so later changes of objects are not dumped), and written
+# to stdout or file in batches of batch_size lines
+class JsonlSink:
+    def __init__(self, path: Optional[str] = None, batch_size: int = 4096,
+                 buffer_size: int = 1 << 20):
+        self.path: Optional[str] = path
+        self.batch_size: int = batch_size
+        self._lines: List[str] = []
+        self._file = open(path, 'w', encoding='utf-8',
+                          buffering=buffer_size) if path else None
+        # resolve stdout now, e.g. when redirected by pipeline runner
+        self._out = self._file if self._file else sys.stdout
+        # records handed off to dependent stages, see dump_handoff
+        self._records: Optional[List[dict]] = [] \
+            if path and _dump_handoff else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._records = None
+        self.close()
+
+    def write(self, obj):
+        if obj:
+            self._lines.append(to_jsonl(obj))
+            if self._records is not None:
+                self._records.append(to_json_record(obj))
+            if len(self._lines) >= self.batch_size:
+                self.flush()
+
+    def write_all(self, objs: Iterable):
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self):
+        if self._lines:
+            self._lines.append('')
+            self._out.write('\n'.join(self._lines))
+            self._lines = []
+        self._out.flush()
+
+    def close(self):
+        self.flush()
+        if self._file:
+            self._file.close()
+            self._file = None
+            if self._records is not None:
+                register_dump_records(self.path, self._records)
+                self._records = None
+
+
+# pyarrow is optional dependency, required only for Parquet dumps
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        raise ImportError("pyarrow package is required for Parquet "
+                          "dumps, install it with: pip install pyarrow") from e
+    return pyarrow
+
+
+# schema metadata key listing columns stored as JSON strings
+PARQUET_JSON_COLUMNS: bytes = b'repronim.json_columns'
+
+
+def is_parquet_path(path: Optional[str]) -> bool:
+    return bool(path) and str(path).endswith('.parquet')
+
+
+# get dump file path in timing-dumps folder by name, e.g. dump_dicoms,
+# when both JSONL and Parquet dumps exist the most recently written one
+# is used, JSONL one if they have the same mtime
+def get_dump_file(dumps_path: str, name: str) -> str:
+    path: str = os.path.join(dumps_path, f"{name}.jsonl")
+    path_parquet: str = os.path.join(dumps_path, f"{name}.parquet")
+    if not os.path.exists(path_parquet):
+        return path
+    if not os.path.exists(path) or \
+            os.stat(path_parquet).st_mtime_ns > os.stat(path).st_mtime_ns:
+        return path_parquet
+    return path
+
+
+def _to_row(obj) -> dict:
+    row: dict = obj.model_dump() if isinstance(obj, BaseModel) else obj
+    return {k: v.value if isinstance(v, Enum) else v
+            for k, v in row.items()}
+
+
+# serialize value the same way as model_dump_json does
+def _to_json_value(v) -> Optional[str]:
+    if v is None:
+        return None
+    return pydantic_core.to_json(v, inf_nan_mode='null').decode('utf-8')
+
+
+# Parquet output sink with the same interface as JsonlSink, records
+# are collected and written as single table on close. Datetime values
+# are stored as typed timestamp columns, nested or mixed type values
+# as JSON strings listed in PARQUET_JSON_COLUMNS schema metadata
+class ParquetSink:
+    def __init__(self, path: Optional[str] = None):
+        self.pa = import_pyarrow()
+        self.path: Optional[str] = path
+        self._rows: List[dict] = []
+        # resolve stdout now, e.g. when redirected by pipeline runner
+        self._out = path if path else sys.stdout.buffer
+        # records handed off to dependent stages, see dump_handoff
+        self._records: Optional[List[dict]] = [] \
+            if path and _dump_handoff else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type:
+            self._records = None
+        self.close()
+
+    def write(self, obj):
+        if obj:
+            # copy to keep record state at the time of writing
+            self._rows.append(_to_row(obj))
+            if self._records is not None:
+                # the same as parse_parquet_gen, which omits nulls
+                self._records.append({k: v for k, v in
+                                      to_json_record(obj).items()
+                                      if v is not None})
+
+    def write_all(self, objs: Iterable):
+        for obj in objs:
+            self.write(obj)
+
+    def flush(self):
+        pass
+
+    def build_table(self):
+        pa = self.pa
+        names: dict = {}
+        for row in self._rows:
+            names.update(dict.fromkeys(row))
+        arrays: List = []
+        json_columns: List[str] = []
+        for name in names:
+            values: List = [row.get(name) for row in self._rows]
+            arr = None
+            if not any(isinstance(v, dict) for v in values):
+                try:
+                    arr = pa.array(values)
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    pass
+            if arr is None:
+                arr = pa.array([_to_json_value(v) for v in values],
+                               type=pa.string())
+                json_columns.append(name)
+            arrays.append(arr)
+        return pa.Table.from_arrays(
+            arrays, names=list(names),
+            metadata={PARQUET_JSON_COLUMNS: json.dumps(json_columns)})
+
+    def close(self):
+        if self._out is None:
+            return
+        self.pa.parquet.write_table(self.build_table(), self._out)
+        self._rows = []
+        self._out = None
+        if self._records is not None:
+            register_dump_records(self.path, self._records)
+            self._records = None
+
+
+# current JSONL output sink used by dump_jsonl, None to print
+# records to stdout one by one
+_jsonl_sink = None
+
+
+# route all dump_jsonl output within the block to buffered sink
+# writing to file path or stdout, Parquet sink is used when path
+# has .parquet extension or format is 'parquet'
+@contextmanager
+def jsonl_output(path: Optional[str] = None,
+                 format: Optional[str] = None) -> Generator:
+    global _jsonl_sink
+    prev = _jsonl_sink
+    parquet: bool = format == 'parquet' if format else is_parquet_path(path)
+    with (ParquetSink(path) if parquet else JsonlSink(path)) as sink:
+        _jsonl_sink = sink
+        try:
+            yield sink
+        finally:
+            _jsonl_sink = prev
 
 
 def dump_jsonl(obj):
     if obj:
-        if isinstance(obj, BaseModel):
-            print(obj.model_dump_json())
+        if _jsonl_sink:
+            _jsonl_sink.write(obj)
         else:
-            print(json.dumps(obj, ensure_ascii=False))
+            print(to_jsonl(obj))
 
 
+# get path of small study/series summary written by dump_dicoms next
+# to DICOMs dump, e.g. dump_dicoms_studies.jsonl
+def get_study_summary_path(dump_dicoms_path: str) -> str:
+    root, _ = os.path.splitext(dump_dicoms_path)
+    return f"{root}_studies.jsonl"
+
+
+# study ranges already found in process, keyed by dump path, size,
+# mtime and summary size and mtime, so stages running in the same
+# interpreter parse dump_dicoms.jsonl only once
+_study_ranges: dict = {}
+
 def find_study_range(dump_dicoms_path: str) -> Tuple[Optional[datetime], Optional[datetime]]:
-    with (jsonlines.open(dump_dicoms_path) as reader):
-        for obj in reader:
-            if obj.get('type') == 'StudyRecord' and obj.get('name') == 'dbic^QA':
-                res = pd.to_datetime(obj['range_isotime_start']), pd.to_datetime(obj['range_isotime_end'])
-                return res;
-        return None, None
+    st = os.stat(dump_dicoms_path)
+    path: str = get_study_summary_path(dump_dicoms_path)
+    summary_st = os.stat(path) if os.path.exists(path) else None
+    key = (os.path.abspath(dump_dicoms_path), st.st_size, st.st_mtime_ns,
+           summary_st and (summary_st.st_size, summary_st.st_mtime_ns))
+    if key in _study_ranges:
+        return _study_ranges[key]
+    # use study summary when its stamp matches the dump size and mtime,
+    # otherwise e.g. for dumps generated by older dump_dicoms or changed
+    # after the summary, scan the whole dump
+    stamp: Optional[dict] = next(parse_jsonl_gen(path, types=['DumpStampRecord']),
+                                 None) if summary_st else None
+    if not stamp or stamp.get('size') != st.st_size or \
+            stamp.get('mtime_ns') != st.st_mtime_ns:
+        logger.debug(f"No up-to-date study summary {path}, "
+                     f"scan {dump_dicoms_path}")
+        path = dump_dicoms_path
+    res = None, None
+    for obj in parse_jsonl_gen(path, types=['StudyRecord']):
+        if obj.get('name') == 'dbic^QA':
+            res = pd.to_datetime(obj['range_isotime_start']), pd.to_datetime(obj['range_isotime_end'])
+            break
+    _study_ranges[key] = res
+    return res
 
 
 _last_id: dict = {
@@ -58,29 +392,366 @@ def generate_id(name: str) -> str:
     return f"{name}-{_last_id[name]:06d}"
 
 
+def reset_ids():
+    # restart all id sequences, e.g. before next dump in the same process
+    for name in _last_id:
+        _last_id[name] = 0
+
+
 def get_session_id(path: str) -> str:
     # extract session id from path
     return Path(path).name
 
 
-def parse_jsonl_gen(path: str) -> Generator[dict, None, None]:
-    with jsonlines.open(path) as reader:
-        for obj in reader:
+# JSONL record type, when "type" is the first record field, so it
+# can be checked without decoding of the whole record
+_re_jsonl_type: re.Pattern = re.compile(rb'\s*\{\s*"type"\s*:\s*"([^"\\]*)"')
+
+
+# get JSONL record type without decoding, None when "type" is not
+# the first record field
+def get_jsonl_line_type(line: bytes) -> Optional[str]:
+    m = _re_jsonl_type.match(line)
+    return m.group(1).decode('utf-8') if m else None
+
+
+# memory-mapped JSONL file reader, newline offsets are scanned once,
+# and records are decoded lazily on random access by index or while
+# iterating, optionally only records of specified types and only
+# specified fields
+class JsonlReader(Sequence):
+    def __init__(self, path: str):
+        self.path: str = path
+        self._file = open(path, 'rb')
+        self._mm: Optional[mmap.mmap] = None
+        starts = ends = np.empty(0, dtype=np.int64)
+        size: int = os.fstat(self._file.fileno()).st_size
+        if size > 0:
+            self._mm = mmap.mmap(self._file.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            buf = np.frombuffer(self._mm, dtype=np.uint8)
+            ends = np.flatnonzero(buf == 0x0A)
+            if buf[-1] != 0x0A:
+                ends = np.append(ends, size)
+            # release buffer, otherwise mmap can't be closed
+            del buf
+            starts = np.concatenate(([0], ends[:-1] + 1))
+        # skip empty lines
+        keep = ends > starts
+        self._starts: np.ndarray = starts[keep]
+        self._ends: np.ndarray = ends[keep]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def get_line(self, i: int) -> bytes:
+        return self._mm[self._starts[i]:self._ends[i]]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("JSONL record index out of range")
+        return json.loads(self.get_line(i))
+
+    def __iter__(self):
+        return self.iter()
+
+    def iter_lines(self) -> Generator[bytes, None, None]:
+        mm: mmap.mmap = self._mm
+        for start, end in zip(self._starts.tolist(), self._ends.tolist()):
+            yield mm[start:end]
+
+    def iter(self, types: Optional[Iterable[str]] = None,
+             fields: Optional[Sequence[str]] = None) -> Generator[dict, None, None]:
+        types = set(types) if types else None
+        for line in self.iter_lines():
+            if types:
+                line_type: Optional[str] = get_jsonl_line_type(line)
+                if line_type and line_type not in types:
+                    continue
+            obj: dict = json.loads(line)
+            if types and obj.get('type') not in types:
+                continue
+            if fields:
+                obj = {k: obj[k] for k in fields if k in obj}
             yield obj
 
-
-def parse_jsonl(path: str) -> List:
-    return [obj for obj in parse_jsonl_gen(path)]
+    def close(self):
+        if self._mm:
+            self._mm.close()
+            self._mm = None
+        self._file.close()
+
+
+# read Parquet dump records as dicts in the same form as parsed from
+# JSONL dump: timestamps as isotime strings, JSON columns decoded and
+# missing (null) values omitted
+def parse_parquet_gen(path: str, types: Optional[Iterable[str]] = None,
+                      fields: Optional[Sequence[str]] = None) -> Generator[dict, None, None]:
+    pq = import_pyarrow().parquet
+    pf = pq.ParquetFile(path, memory_map=True)
+    metadata: dict = pf.schema_arrow.metadata or {}
+    json_columns: set = set(json.loads(metadata.get(PARQUET_JSON_COLUMNS,
+                                                    b'[]')))
+    types = set(types) if types else None
+    columns: Optional[List[str]] = None
+    if fields:
+        names: set = set(pf.schema_arrow.names)
+        columns = [k for k in dict.fromkeys([*fields, 'type'])
+                   if k in names]
+    for batch in pf.iter_batches(columns=columns):
+        for row in batch.to_pylist():
+            if types and row.get('type') not in types:
+                continue
+            obj: dict = {}
+            for k, v in row.items():
+                if v is None or (fields and k not in fields):
+                    continue
+                if k in json_columns:
+                    v = json.loads(v)
+                elif isinstance(v, datetime):
+                    v = v.isoformat()
+                obj[k] = v
+            yield obj
 
 
-def parse_isotime(v: str) -> datetime:
+# iterate in-memory dump records the same way as JsonlReader.iter,
+# records are copied, so callers can change them
+def iter_dump_records(records: List[dict],
+                      types: Optional[Iterable[str]] = None,
+                      fields: Optional[Sequence[str]] = None) -> Generator[dict, None, None]:
+    types = set(types) if types else None
+    for obj in records:
+        if types and obj.get('type') not in types:
+            continue
+        if fields:
+            yield {k: obj[k] for k in fields if k in obj}
+        else:
+            yield dict(obj)
+
+
+# parse JSONL or Parquet dump, optionally only records of specified
+# types and only specified fields of them, dumps written in the same
+# process within dump_handoff are not read again
+def parse_jsonl_gen(path: str, types: Optional[Iterable[str]] = None,
+                    fields: Optional[Sequence[str]] = None) -> Generator[dict, None, None]:
+    records: Optional[List[dict]] = get_dump_records(path)
+    if records is not None:
+        yield from iter_dump_records(records, types, fields)
+        return
+    if is_parquet_path(path):
+        yield from parse_parquet_gen(path, types, fields)
+        return
+    with JsonlReader(path) as reader:
+        yield from reader.iter(types, fields)
+
+
+def parse_jsonl(path: str, types: Optional[Iterable[str]] = None,
+                fields: Optional[Sequence[str]] = None) -> List:
+    return [obj for obj in parse_jsonl_gen(path, types, fields)]
+
+
+# load JSONL or Parquet dump as DataFrame, Parquet columns are memory
+# mapped and keep their types, e.g. for multi-session analysis
+def read_dump_frame(path: str) -> pd.DataFrame:
+    if is_parquet_path(path):
+        import_pyarrow()
+        return pd.read_parquet(path, memory_map=True)
+    return pd.read_json(path, lines=True)
+
+
+# parse ISO datetime string to naive local timestamp, tz-aware values
+# are converted to America/New_York timezone, or just stripped when
+# tz_convert is False. Uses datetime.fromisoformat and falls back to
+# pd.to_datetime only for formats not supported by it.
+def parse_isotime(v: str, tz_convert: bool = True) -> datetime:
     if not v:
         return None
-    ts = pd.to_datetime(v)
-    if ts.tzinfo is not None:
-        ts = ts.tz_convert('America/New_York')
-    isotime = ts.tz_localize(None)
-    return isotime
+    try:
+        if _re_sub_us.search(v):
+            raise ValueError(f"sub-microsecond isotime: {v}")
+        dt: datetime = datetime.fromisoformat(v)
+    except (TypeError, ValueError):
+        ts = pd.to_datetime(v)
+        if ts.tzinfo is not None and tz_convert:
+            ts = ts.tz_convert(_tz_local)
+        return ts.tz_localize(None) if ts.tzinfo is not None else ts
+    if dt.tzinfo is not None:
+        if tz_convert:
+            dt = dt.astimezone(_tz_local)
+        dt = dt.replace(tzinfo=None)
+    return pd.Timestamp(dt).as_unit(_isotime_unit)
+
+
+# parse column of ISO datetime strings at once, the same as
+# parse_isotime applied to each value
+def parse_isotimes(values: Iterable[str],
+                   tz_convert: bool = True) -> pd.Series:
+    ser: pd.Series = values if isinstance(values, pd.Series) \
+        else pd.Series(list(values), dtype=object)
+    try:
+        ts: pd.Series = pd.to_datetime(ser, format='ISO8601')
+    except (TypeError, ValueError):
+        # e.g. mixed timezones offsets, parse values one by one
+        return ser.map(lambda v: parse_isotime(v, tz_convert))
+    if ts.dt.tz is not None:
+        if tz_convert:
+            ts = ts.dt.tz_convert(_tz_local)
+        ts = ts.dt.tz_localize(None)
+    return ts
+
+
+# find offset of the first line in time-ordered text file with
+# timestamp >= dt (side='left') or > dt (side='right'). Uses binary
+# search over byte offsets between lo and hi line offsets, get_time
+# parses line timestamp and returns None for lines without it, e.g.
+# comments. Returns hi (file size by default) when there is no such
+# line.
+def bisect_isotime(f: BinaryIO, dt: datetime,
+                   get_time: Callable[[bytes], Optional[datetime]],
+                   side: str = 'left', lo: int = 0,
+                   hi: Optional[int] = None) -> int:
+    def is_target(ts: datetime) -> bool:
+        return ts >= dt if side == 'left' else ts > dt
+
+    if hi is None:
+        f.seek(0, os.SEEK_END)
+        hi = f.tell()
+    # lo is line offset until first probe
+    in_line: bool = False
+    while hi - lo > _bisect_block_size:
+        mid: int = (lo + hi) // 2
+        f.seek(mid)
+        f.readline()
+        ts: Optional[datetime] = None
+        while ts is None:
+            line: bytes = f.readline()
+            if not line:
+                break
+            ts = get_time(line)
+        if ts is None or is_target(ts):
+            hi = mid
+        else:
+            lo, in_line = mid, True
+
+    # scan the rest of lines one by one
+    f.seek(lo)
+    if in_line:
+        f.readline()
+    while True:
+        pos: int = f.tell()
+        if pos >= hi:
+            return hi
+        line: bytes = f.readline()
+        if not line:
+            return pos
+        ts = get_time(line)
+        if ts is not None and is_target(ts):
+            return pos
+
+
+# sparse time index of time-ordered raw log file, stored as sidecar
+# JSON file next to the log
+class TimeIndex(BaseModel):
+    size: int = Field(..., description="Indexed log file size")
+    mtime_ns: int = Field(..., description="Indexed log file mtime "
+                                           "in nanoseconds")
+    step: int = Field(..., description="Number of lines between marks")
+    isotimes: List[datetime] = Field([], description="Timestamps of "
+                                                     "indexed lines")
+    offsets: List[int] = Field([], description="Byte offsets of "
+                                               "indexed lines")
+    dtypes: Dict[str, str] = Field({}, description="CSV columns dtypes "
+                                                   "inferred from the "
+                                                   "whole file")
+
+    # narrow (lo, hi) offsets range which contains the first line with
+    # timestamp >= dt (side='left') or > dt (side='right')
+    def get_range(self, dt: datetime, side: str = 'left',
+                  lo: int = 0) -> Tuple[int, Optional[int]]:
+        i: int = bisect.bisect_left(self.isotimes, dt) if side == 'left' \
+            else bisect.bisect_right(self.isotimes, dt)
+        if i > 0:
+            lo = max(lo, self.offsets[i - 1])
+        hi: Optional[int] = self.offsets[i] if i < len(self.offsets) \
+            else None
+        if hi is not None and hi < lo:
+            hi = lo
+        return lo, hi
+
+
+def get_time_index_path(path: str) -> str:
+    return f"{path}.tidx"
+
+
+# build sparse time index with every step-th line timestamp and offset,
+# lines before lo offset (e.g. CSV header) are not indexed
+def build_time_index(path: str,
+                     get_time: Callable[[bytes], Optional[datetime]],
+                     step: int = 1000, lo: int = 0) -> TimeIndex:
+    st = os.stat(path)
+    res: TimeIndex = TimeIndex(size=st.st_size, mtime_ns=st.st_mtime_ns,
+                               step=step)
+    with open(path, 'rb') as f:
+        f.seek(lo)
+        pos: int = lo
+        pending: bool = True
+        for i, line in enumerate(f):
+            if i % step == 0:
+                pending = True
+            if pending:
+                ts: Optional[datetime] = get_time(line)
+                if ts is not None:
+                    res.isotimes.append(ts)
+                    res.offsets.append(pos)
+                    pending = False
+            pos += len(line)
+    return res
+
+
+def save_time_index(path: str, index: TimeIndex):
+    with open(get_time_index_path(path), 'w') as f:
+        f.write(index.model_dump_json())
+
+
+# load sidecar time index of the log file, None when it does not exist
+# or log file was modified after indexing
+def load_time_index(path: str) -> Optional[TimeIndex]:
+    index_path: str = get_time_index_path(path)
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with open(index_path, 'r') as f:
+            index: TimeIndex = TimeIndex.model_validate_json(f.read())
+    except Exception as e:
+        logger.warning(f"Failed to load time index {index_path}: {e}")
+        return None
+    st = os.stat(path)
+    if index.size != st.st_size or index.mtime_ns != st.st_mtime_ns:
+        logger.warning(f"Outdated time index {index_path}, ignored")
+        return None
+    return index
+
+
+# the same as bisect_isotime, but search range is narrowed with time
+# index when it is specified
+def seek_isotime(f: BinaryIO, dt: datetime,
+                 get_time: Callable[[bytes], Optional[datetime]],
+                 side: str = 'left', lo: int = 0,
+                 index: Optional[TimeIndex] = None) -> int:
+    hi: Optional[int] = None
+    if index:
+        lo, hi = index.get_range(dt, side, lo)
+    return bisect_isotime(f, dt, get_time, side, lo, hi)
 
 
 def str_isotime(v: datetime) -> str:
@@ -89,6 +760,21 @@ def str_isotime(v: datetime) -> str:
     return v.strftime("%Y-%m-%dT%H:%M:%S.%f")
 
 
+def to_datetime64(v: datetime) -> np.datetime64:
+    return np.datetime64(pd.Timestamp(v).to_datetime64(), 'ns')
+
+
+# vectorized pd.Timedelta.total_seconds for array of timedelta64,
+# follows pandas float arithmetic to produce bit-exact results
+def total_seconds(v: np.ndarray) -> np.ndarray:
+    us: np.ndarray = v.astype('timedelta64[ns]').astype(np.int64) // 1000
+    days: np.ndarray = us // 86_400_000_000
+    us = us - days * 86_400_000_000
+    seconds: np.ndarray = us // 1_000_000
+    us = us - seconds * 1_000_000
+    return (days * 86400 + seconds) + us / 1_000_000
+
+
 # define ReproNim clocks
 class Clock(str, Enum):
     ISOTIME = "isotime"   # Reference NTP clock
@@ -118,6 +804,24 @@ class TPeriodData(BaseModel):
                            "to expected deviations")
 
 
+# Define fitted clock drift segment model, within segment clock
+# offset related to reference isotime changes linearly
+class TSegmentData(BaseModel):
+    clock: Optional[Clock] = Field(None, description="Fitted clock")
+    session_id: Optional[str] = Field(None, description="Session identifier")
+    isotime_start: Optional[datetime] = Field(
+        None, description="Reference time of the first segment mark")
+    isotime_end: Optional[datetime] = Field(
+        None, description="Reference time of the last segment mark")
+    count: Optional[int] = Field(0, description="Number of segment marks")
+    offset: Optional[float] = Field(
+        0.0, description="Fitted clock offset at segment start in seconds")
+    deviation: Optional[float] = Field(
+        1.0, description="Fitted clock deviation related to master clock")
+    residual: Optional[float] = Field(
+        0.0, description="Median absolute residual of the fit in seconds")
+
+
 # Define abstract timing map model
 class TMapRecord(BaseModel):
     isotime: Optional[datetime] = Field(
@@ -250,50 +954,193 @@ def get_tmap_deviation(clock: Clock, tmap: TMapRecord) -> float:
         raise ValueError(f"Unknown clock: {clock}")
 
 
-# get tmap unique key
-def get_tmap_key(tmap: TMapRecord) -> str:
-    return f"{tmap.session_id}|{tmap.mark_id}"
+# find tmap fields prefix by clock, None for reference clock
+def get_tmap_prefix(clock: Clock) -> Optional[str]:
+    if clock == Clock.ISOTIME:
+        return None
+    if clock == Clock.QRINFO:
+        return "reprostim_video"
+    return clock.value
+
+
+# get drift rates (slopes) between all pairs of marks at least
+# _drift_min_span seconds apart, large segments are evenly subsampled
+def get_pair_slopes(x: np.ndarray, y: np.ndarray) -> np.ndarray:
+    if len(x) > _drift_max_points:
+        sel: np.ndarray = np.unique(np.linspace(
+            0, len(x) - 1, _drift_max_points).astype(np.int64))
+        x, y = x[sel], y[sel]
+    i, j = np.triu_indices(len(x), 1)
+    dx: np.ndarray = x[j] - x[i]
+    mask: np.ndarray = np.abs(dx) >= _drift_min_span
+    return (y[j] - y[i])[mask] / dx[mask]
+
+
+# get clock step threshold from robust sigma (scaled median absolute
+# deviation) of offset changes between sequential marks of the same
+# group (session)
+def get_step_threshold(y: np.ndarray, groups: np.ndarray) -> float:
+    dy: np.ndarray = np.diff(y)[groups[1:] == groups[:-1]]
+    if len(dy) == 0:
+        return _drift_step_tolerance
+    sigma: float = 1.4826 * float(np.median(np.abs(dy - np.median(dy))))
+    return max(_drift_step_tolerance, _drift_step_sigmas * sigma)
+
+
+# split sequential marks into segments on group (session) change or
+# detected clock step, returns segment number for each mark
+def find_clock_steps(x: np.ndarray, y: np.ndarray,
+                     groups: np.ndarray) -> np.ndarray:
+    if len(x) == 0:
+        return np.zeros(0, dtype=np.int64)
+    steps: np.ndarray = np.abs(np.diff(y)) > (
+        get_step_threshold(y, groups) +
+        _drift_max_rate * np.abs(np.diff(x)))
+    steps |= groups[1:] != groups[:-1]
+    return np.concatenate([[0], np.cumsum(steps)])
+
+
+# build columnar tmap frame from JSON objects or TMapRecord list,
+# JSON objects are validated as TMapRecord, so missing fields are set
+# to defaults, and session_id stored as categorical column
+def build_tmap_frame(objs: List) -> pd.DataFrame:
+    objs = [(obj if isinstance(obj, TMapRecord)
+             else TMapRecord.model_validate(obj)).model_dump()
+            for obj in objs]
+    cols: dict = {}
+    for name, field in TMapRecord.model_fields.items():
+        values: List = [obj.get(name, field.default) for obj in objs]
+        if field.annotation == Optional[datetime]:
+            cols[name] = pd.to_datetime(pd.Series(values, dtype=object),
+                                        format='ISO8601'
+                                        ).astype('datetime64[ns]')
+        elif field.annotation == Optional[float]:
+            cols[name] = np.array(values, dtype=np.float64)
+        elif name == 'session_id':
+            cols[name] = pd.Categorical(values)
+        else:
+            cols[name] = np.array(values, dtype=object)
+    return pd.DataFrame(cols)
+
+
+# Define read-only list of tmap records backed by columnar
+# frame, TMapRecord objects are created on demand only
+class TMapRecordList(Sequence):
+    def __init__(self, df: pd.DataFrame = None):
+        self.df = df if df is not None else build_tmap_frame([])
+        self._arrays = {name: self.df[name].to_numpy()
+                        for name in self.df.columns}
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("tmap record index out of range")
+        return TMapRecord(**{name: self.get_value(name, i)
+                             for name in self._arrays})
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    # get column values as python objects, the same as record
+    # attributes, e.g. None for missing values
+    def column(self, name: str) -> List:
+        arr: np.ndarray = self._arrays[name]
+        if arr.dtype.kind == 'M':
+            return arr.astype('datetime64[us]').tolist()
+        return [None if pd.isna(v) else v for v in arr.tolist()]
+
+    # get python value of the certain field of the record
+    def get_value(self, name: str, i: int):
+        v = self._arrays[name][i]
+        if pd.isna(v):
+            return None
+        if isinstance(v, np.datetime64):
+            return pd.Timestamp(v).to_pydatetime()
+        if isinstance(v, np.floating):
+            return float(v)
+        return v
 
 
 # Define ReproNim timing map service
 class TMapService:
     def __init__(self, path_or_marks: str | List = None):
-        self.marks = []
-        self.periods = {}
+        self.marks = TMapRecordList()
+        self.periods = []
         self.avg_period = TPeriodData()
+        self.segments = {}
+        self._fits = {}
         self._force_offset = {}
+        self._clock_index = {clock: i for i, clock in enumerate(Clock)}
+        self.build_tables()
         if path_or_marks:
             self.load(path_or_marks)
 
-    # adjust clock offset using correction
-    def adjust_offset(self, offset: float,
-                      clock: Clock,
-                      dt: datetime,
-                      tmap: TMapRecord) -> float:
-        # limit to DICOMs clock only atm
-        if clock!=Clock.DICOMS:
-            return offset
-
-        # skip correction when offset manually is specified/hardcoded
-        if self._force_offset.get(clock.value) is not None:
-            return offset
-
-        tp: TPeriodData = self.get_period(tmap)
-        if not tp:
-            logger.debug("use avg period")
-            tp = self.avg_period
-
-        # for invalid periods use average deviation
-        # but in future this can be tuned up on demand
-        if not tp.dicoms_valid:
-            logger.debug("use avg period instead of invalid one")
-            tp = self.avg_period
-
-        # delta sec
-        d: float = (dt - tmap.isotime).total_seconds()
-        correction: float = d * tp.dicoms_deviation - d
-        adjusted_offset: float = offset + correction
-        return adjusted_offset
+    # compile marks into dense marks x clocks tables with isotime and
+    # offset (forced offsets already applied), so
+    # conversion is done by indexing rather than per clock dispatch,
+    # should be rebuilt each time marks or forced offsets are changed.
+    # Conversion uses fitted offsets and deviations of drift model.
+    def build_tables(self):
+        df: pd.DataFrame = self.marks.df
+        n: int = len(df)
+        c: int = len(self._clock_index)
+        self._isotimes = df['isotime'].to_numpy(dtype='datetime64[ns]')
+        self._isotimes_py = self.marks.column('isotime')
+        self._tmap_isotimes = np.empty((n, c), dtype='datetime64[ns]')
+        self._tmap_offsets = np.empty((n, c), dtype=np.float64)
+        self._fit_offsets = np.empty((n, c), dtype=np.float64)
+        self._adjust_deviations = np.ones((n, c), dtype=np.float64)
+        self._adjust_clocks = np.zeros(c, dtype=bool)
+        for clock, j in self._clock_index.items():
+            prefix: str = get_tmap_prefix(clock)
+            if prefix is None:
+                self._tmap_isotimes[:, j] = self._isotimes
+                self._tmap_offsets[:, j] = 0.0
+            else:
+                self._tmap_isotimes[:, j] = df[f"{prefix}_isotime"].to_numpy(
+                    dtype='datetime64[ns]')
+                self._tmap_offsets[:, j] = df[f"{prefix}_offset"].to_numpy()
+            forced: float = self._force_offset.get(clock.value)
+            if forced is not None:
+                self._tmap_offsets[:, j] = forced
+            self._fit_offsets[:, j] = self._tmap_offsets[:, j]
+            # skip correction when offset manually is specified/hardcoded
+            if forced is not None:
+                continue
+            # marks not covered by fitted segments use DICOMs periods
+            # deviation, as DICOMs is the only clock periods are
+            # calculated for
+            if clock == Clock.DICOMS and n > 0:
+                self._adjust_deviations[:, j] = [
+                    self.get_adjust_period(i).dicoms_deviation
+                    for i in range(n)]
+                self._adjust_clocks[j] = True
+            fit = self._fits.get(clock)
+            if fit is not None:
+                positions, offsets, deviations = fit
+                self._fit_offsets[positions, j] = offsets
+                self._adjust_deviations[positions, j] = deviations
+                self._adjust_clocks[j] = True
+        self.build_index()
+
+    # build per clock isotime index for find_tmap lookup, marks are
+    # sorted by reference isotime, so other clocks may be not monotonic
+    # (e.g. clock correction), and index keeps running maximum of the
+    # clock isotime, which makes binary search to return the same mark
+    # as sequential scan till the first mark after the datetime
+    def build_index(self):
+        self._index = {}
+        for clock, j in self._clock_index.items():
+            isotimes: np.ndarray = self._tmap_isotimes[:, j]
+            # skip marks without time in this clock
+            positions: np.ndarray = np.flatnonzero(~np.isnat(isotimes))
+            isotimes = isotimes[positions]
+            if len(isotimes) > 0:
+                isotimes = np.maximum.accumulate(isotimes)
+            self._index[clock] = (positions, isotimes)
 
     # calculate inter-series periods based on sequential
     # and sorted marks data
@@ -304,37 +1151,39 @@ class TMapService:
                                       dicoms_duration=0.0,
                                       dicoms_deviation=1.0,
                                       dicoms_valid = True)
-        prev_mark: TMapRecord = None
-        for mark in self.marks:
-            if prev_mark:
-                tp: TPeriodData = TPeriodData()
-                tp.key = get_tmap_key(prev_mark)
-                tp.duration = (mark.isotime - prev_mark.isotime).total_seconds()
-                tp.deviation = 1.0
-                tp.dicoms_duration = (mark.dicoms_isotime -
-                                      prev_mark.dicoms_isotime).total_seconds()
-                if tp.duration and tp.duration!=0:
-                    tp.dicoms_deviation = tp.dicoms_duration/tp.duration
-                expected_offset: float = (prev_mark.dicoms_offset +
-                                          tp.duration * tp.dicoms_deviation -
-                                          tp.dicoms_duration)
-                offset_diff: float = expected_offset-mark.dicoms_offset
-                # detected clock correction, mark period as invalid
-                # tune this 30 sec interval later
-                tp.dicoms_valid = True if abs(offset_diff) < 30.0 else False
-                # logger.debug(f"expected_offset={expected_offset} / real={mark.dicoms_offset}, diff={offset_diff}, duration={tp.duration}, delta={tp.duration * tp.dicoms_deviation}")
-                # logger.debug(f"DELTA = {1000*(tp.dicoms_deviation-mark.dicoms_deviation)}")
-                self.periods[tp.key] = tp
-
-                # for valid periods calculate global average deviation
-                # where each valid deviation added proportionally to the
-                # period duration
-                if tp.dicoms_valid:
-                    ap.duration += tp.duration
-                    ap.dicoms_duration += tp.dicoms_duration;
-                    ap.dicoms_deviation += (tp.dicoms_duration/100)*tp.dicoms_deviation
-
-            prev_mark = mark
+        self.periods = [None] * len(self.marks)
+        session_ids: List[str] = self.marks.column('session_id')
+        mark_ids: List[str] = self.marks.column('mark_id')
+        isotimes: List[datetime] = self.marks.column('isotime')
+        dicoms_isotimes: List[datetime] = self.marks.column('dicoms_isotime')
+        dicoms_offsets: List[float] = self.marks.column('dicoms_offset')
+        for i in range(1, len(self.marks)):
+            # period is stored by position of the previous mark
+            tp: TPeriodData = TPeriodData()
+            tp.key = f"{session_ids[i-1]}|{mark_ids[i-1]}"
+            tp.duration = (isotimes[i] - isotimes[i-1]).total_seconds()
+            tp.deviation = 1.0
+            tp.dicoms_duration = (dicoms_isotimes[i] -
+                                  dicoms_isotimes[i-1]).total_seconds()
+            if tp.duration and tp.duration!=0:
+                tp.dicoms_deviation = tp.dicoms_duration/tp.duration
+            expected_offset: float = (dicoms_offsets[i-1] +
+                                      tp.duration * tp.dicoms_deviation -
+                                      tp.dicoms_duration)
+            offset_diff: float = expected_offset-dicoms_offsets[i]
+            # detected clock correction, mark period as invalid
+            # tune this 30 sec interval later
+            tp.dicoms_valid = True if abs(offset_diff) < 30.0 else False
+            # logger.debug(f"expected_offset={expected_offset} / real={dicoms_offsets[i]}, diff={offset_diff}, duration={tp.duration}, delta={tp.duration * tp.dicoms_deviation}")
+            self.periods[i-1] = tp
+
+            # for valid periods calculate global average deviation
+            # where each valid deviation added proportionally to the
+            # period duration
+            if tp.dicoms_valid:
+                ap.duration += tp.duration
+                ap.dicoms_duration += tp.dicoms_duration;
+                ap.dicoms_deviation += (tp.dicoms_duration/100)*tp.dicoms_deviation
 
         if ap.dicoms_duration!=0:
             ap.dicoms_deviation /= ap.dicoms_duration / 100
@@ -342,6 +1191,74 @@ class TMapService:
         ap.dicoms_duration = round(ap.dicoms_duration, 1)
         self.avg_period = ap
 
+    # fit piecewise-linear drift model of each clock offset related to
+    # reference isotime with all marks including per-scan ones. Marks
+    # are split into segments by session and detected clock steps, and
+    # segment drift rate is estimated with robust Theil-Sen estimator.
+    # Segments with too few marks, too short span or implausible drift
+    # rate are not fitted, and their marks keep recorded offsets with
+    # DICOMs periods deviation (see build_tables)
+    def fit_segments(self):
+        self.segments = {}
+        self._fits = {}
+        df: pd.DataFrame = self.marks.df
+        isotimes: np.ndarray = df['isotime'].to_numpy(dtype='datetime64[ns]')
+        isotimes_py: List[datetime] = self.marks.column('isotime')
+        session_ids: List[str] = self.marks.column('session_id')
+        groups: np.ndarray = df['session_id'].cat.codes.to_numpy()
+        for clock in Clock:
+            prefix: str = get_tmap_prefix(clock)
+            if prefix is None:
+                continue
+            clock_isotimes: np.ndarray = df[f"{prefix}_isotime"].to_numpy(
+                dtype='datetime64[ns]')
+            offsets: np.ndarray = df[f"{prefix}_offset"].to_numpy()
+            positions: np.ndarray = np.flatnonzero(
+                ~np.isnat(clock_isotimes) & ~np.isnat(isotimes) &
+                ~np.isnan(offsets))
+            if len(positions) == 0:
+                continue
+            x: np.ndarray = total_seconds(isotimes[positions] -
+                                          isotimes[positions[0]])
+            y: np.ndarray = offsets[positions]
+            seg_ids: np.ndarray = find_clock_steps(x, y, groups[positions])
+            parts: List[np.ndarray] = np.split(
+                np.arange(len(positions)),
+                np.flatnonzero(np.diff(seg_ids)) + 1)
+
+            fit_offsets: np.ndarray = np.empty(len(positions))
+            fit_deviations: np.ndarray = np.empty(len(positions))
+            fitted: np.ndarray = np.zeros(len(positions), dtype=bool)
+            segments: List[TSegmentData] = []
+            for p in parts:
+                slopes: np.ndarray = get_pair_slopes(x[p], y[p]) \
+                    if len(p) >= _drift_min_marks else np.empty(0)
+                slope: float = float(np.median(slopes)) \
+                    if len(slopes) > 0 else 0.0
+                if len(slopes) > 0 and abs(slope) <= _drift_max_rate:
+                    dx: np.ndarray = x[p] - x[p[0]]
+                    offset: float = float(np.median(y[p] - slope * dx))
+                    fit_offsets[p] = offset + slope * dx
+                    fitted[p] = True
+                else:
+                    slope = 0.0
+                    offset = float(np.median(y[p]))
+                    fit_offsets[p] = y[p]
+                fit_deviations[p] = 1.0 + slope
+                segments.append(TSegmentData(
+                    clock=clock,
+                    session_id=session_ids[positions[p[0]]],
+                    isotime_start=isotimes_py[positions[p[0]]],
+                    isotime_end=isotimes_py[positions[p[-1]]],
+                    count=len(p),
+                    offset=offset,
+                    deviation=1.0 + slope,
+                    residual=float(np.median(np.abs(y[p] - fit_offsets[p])))))
+            self.segments[clock] = segments
+            if fitted.any():
+                self._fits[clock] = (positions[fitted], fit_offsets[fitted],
+                                     fit_deviations[fitted])
+
     # convert datetime from one ReproNim clock to another
     def convert(self,
                 from_clock: Clock,
@@ -355,51 +1272,121 @@ class TMapService:
         if not from_dt:
             return None
 
-        tmap: TMapRecord = self.find_tmap(from_clock, from_dt)
+        i: int = self.find_tmap_index(from_clock, from_dt)
         # bypass conversion if tmap is not found
-        if tmap is None:
+        if i is None:
             logger.warning(f"tmap not found for {from_dt}")
             return from_dt
 
-        # calculate offset
-        from_offset: float = self.get_offset(from_clock, tmap)
-        from_offset = self.adjust_offset(from_offset,
-                                         from_clock, from_dt, tmap)
-        to_offset: float = self.get_offset(to_clock, tmap)
-        to_offset = self.adjust_offset(to_offset, to_clock,
-                                       from_dt, tmap)
+        # calculate offset with fitted drift model of the mark
+        from_j: int = self._clock_index[from_clock]
+        to_j: int = self._clock_index[to_clock]
+        from_offset: float = self._fit_offsets[i, from_j]
+        to_offset: float = self._fit_offsets[i, to_j]
+        from_deviation: float = self._adjust_deviations[i, from_j]
+        to_deviation: float = self._adjust_deviations[i, to_j]
         logger.debug(f"from_offset={from_offset}, to_offset={to_offset}")
         offset: float = to_offset - from_offset
+        if from_deviation != 1.0 or to_deviation != 1.0:
+            # reference delta sec since the mark, from clock model
+            # is inverted for the datetime in that clock
+            d: float = (from_dt - self._isotimes_py[i]).total_seconds()
+            r: float = min(max((d - from_offset) / from_deviation,
+                               -_drift_max_extrapolation),
+                           _drift_max_extrapolation)
+            offset = offset + r * (to_deviation - from_deviation)
         logger.debug(f"offset={offset}")
 
         return from_dt + pd.Timedelta(offset, unit='s')
 
-    # for debug purposes report tmap table, calculated periods and
-    # global average periods if any
+    # convert array of datetimes (numpy datetime64 array or pandas
+    # Series) from one ReproNim clock to another in one call, result
+    # is the same as convert applied to each item
+    def convert_many(self,
+                     from_clock: Clock,
+                     to_clock: Clock,
+                     from_dts: np.ndarray | pd.Series) -> np.ndarray | pd.Series:
+        # bypass conversion if clocks are the same
+        if from_clock == to_clock:
+            return from_dts
+
+        # bypass conversion if tmap is empty
+        if not self.marks or len(self.marks) == 0:
+            logger.warning(f"tmap not found for {len(from_dts)} datetimes")
+            return from_dts
+
+        dts: np.ndarray = np.asarray(from_dts, dtype='datetime64[ns]')
+        indexes: np.ndarray = self.find_tmap_indexes(from_clock, dts)
+
+        # calculate offsets with fitted drift model of the marks
+        from_j: int = self._clock_index[from_clock]
+        to_j: int = self._clock_index[to_clock]
+        from_offsets: np.ndarray = self._fit_offsets[indexes, from_j]
+        to_offsets: np.ndarray = self._fit_offsets[indexes, to_j]
+        offsets: np.ndarray = to_offsets - from_offsets
+        if self._adjust_clocks[from_j] or self._adjust_clocks[to_j]:
+            from_deviations: np.ndarray = self._adjust_deviations[indexes,
+                                                                  from_j]
+            to_deviations: np.ndarray = self._adjust_deviations[indexes,
+                                                                to_j]
+            # reference delta sec since the marks, the same as convert
+            d: np.ndarray = total_seconds(dts - self._isotimes[indexes])
+            r: np.ndarray = np.clip((d - from_offsets) / from_deviations,
+                                    -_drift_max_extrapolation,
+                                    _drift_max_extrapolation)
+            adjusted: np.ndarray = offsets + r * (to_deviations -
+                                                  from_deviations)
+            offsets = np.where((from_deviations != 1.0) |
+                               (to_deviations != 1.0), adjusted, offsets)
+
+        res: np.ndarray = dts + pd.to_timedelta(offsets, unit='s').to_numpy()
+        if isinstance(from_dts, pd.Series):
+            return pd.Series(res, index=from_dts.index, name=from_dts.name)
+        return res
+
+    # for debug purposes report tmap table, calculated periods,
+    # global average periods and fitted drift segments if any
     def dump_periods(self):
         for i, m in enumerate(self.marks):
-            p: TPeriodData = self.get_period(m)
+            p: TPeriodData = self.get_period(i)
             logger.info(f"[{i:03}] mark   : {m.model_dump_json()}")
             logger.info(f"[{i:03}] period : {p.model_dump_json() if p else None}")
         logger.info(f"avg period   : {self.avg_period.model_dump_json()}")
+        for clock, segments in self.segments.items():
+            for sg in segments:
+                logger.info(f"segment      : {sg.model_dump_json()}")
 
     # find tmap record by datetime and clock in sorted
-    # list of marks
+    # list of marks, returns last mark at or before datetime
+    # in the specified clock
     def find_tmap(self, clock: Clock, dt: datetime) -> TMapRecord:
+        i: int = self.find_tmap_index(clock, dt)
+        return None if i is None else self.marks[i]
+
+    # find tmap record position in list of marks by datetime
+    # and clock, or None if tmap is empty
+    def find_tmap_index(self, clock: Clock, dt: datetime) -> int:
         if not self.marks or len(self.marks) == 0:
             return None
         if len(self.marks) == 1:
-            return self.marks[0]
-
-        last_mark = self.marks[0]
-
-        for mark in self.marks:
-            # lookup based on provided clock using appropriate
-            # ***_isotime field
-            if get_tmap_isotime(clock, mark) > dt:
-                break
-            last_mark = mark
-        return last_mark
+            return 0
+        return int(self.find_tmap_indexes(clock, to_datetime64(dt)))
+
+    # find tmap records positions in list of marks for array of
+    # datetimes in the specified clock
+    def find_tmap_indexes(self, clock: Clock,
+                          dts: np.ndarray) -> np.ndarray:
+        index = self._index.get(clock)
+        if index is None:
+            raise ValueError(f"Unknown clock: {clock}")
+        positions, isotimes = index
+        if len(positions) == 0:
+            return np.zeros(np.shape(dts), dtype=np.int64)
+
+        # first mark which is later than dt, so previous one is
+        # the last mark at or before dt
+        i: np.ndarray = np.searchsorted(isotimes, dts, side='right')
+        return positions[np.maximum(i - 1, 0)]
 
     # force offset for certain clock
     def force_offset(self, clock: str, offset: float):
@@ -409,40 +1396,49 @@ class TMapService:
         else:
             logger.debug("forcing offset for %s: %f", clock, offset)
             self._force_offset[clock] = offset
+        self.build_tables()
 
-    # override clock offset if any
-    def get_offset(self, clock: Clock, tmap: TMapRecord) -> float:
-        if self._force_offset.get(clock.value) is not None:
-            logger.debug("overriding offset for %s: %f",
-                         clock,
-                         self._force_offset[clock.value])
-            return self._force_offset[clock.value]
-        return get_tmap_offset(clock, tmap)
+    # get period started by mark at position
+    def get_period(self, i: int) -> TPeriodData:
+        return self.periods[i]
 
-    # get period by tmap/mark
-    def get_period(self, tmap: TMapRecord) -> TPeriodData:
-        key: str = get_tmap_key(tmap)
-        return self.periods.get(key)
+    # get period used to adjust DICOMs offset for mark at position
+    def get_adjust_period(self, i: int) -> TPeriodData:
+        tp: TPeriodData = self.get_period(i)
+        if not tp:
+            logger.debug("use avg period")
+            tp = self.avg_period
+
+        # for invalid periods use average deviation
+        # but in future this can be tuned up on demand
+        if not tp.dicoms_valid:
+            logger.debug("use avg period instead of invalid one")
+            tp = self.avg_period
+        return tp
 
     # load marks from file
     def load(self, path_or_marks: str | List):
         if isinstance(path_or_marks, str):
-            for obj in parse_jsonl_gen(path_or_marks):
-                self.marks.append(TMapRecord(**obj))
+            df: pd.DataFrame = build_tmap_frame(parse_jsonl(path_or_marks))
         else:
-            for obj in path_or_marks:
-                self.marks.append(TMapRecord(**obj))
+            df: pd.DataFrame = build_tmap_frame(list(path_or_marks))
+        if len(self.marks) > 0:
+            df = pd.concat([self.marks.df, df], ignore_index=True)
+            df['session_id'] = df['session_id'].astype('category')
 
         # sort by isotime
-        self.marks.sort(key=lambda x: x.isotime)
+        df = df.sort_values('isotime', kind='stable', ignore_index=True)
+        self.marks = TMapRecordList(df)
         self.calc_periods()
+        self.fit_segments()
+        self.build_tables()
 
     def to_label(self) -> str:
         # dump number of marks and each mark in format [N]=isotime
         if len(self.marks) == 0:
             return "TMap is empty"
         return f"TMap marks count {len(self.marks)} : " \
-               + ", ".join([f"[{i}]={str_isotime(mark.isotime)}" for i, mark in enumerate(self.marks)])
+               + ", ".join([f"[{i}]={str_isotime(isotime)}" for i, isotime in enumerate(self._isotimes_py)])
 
 
 _tmap_svc: TMapService = None
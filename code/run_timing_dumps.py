@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+import getpass
+import importlib
+import os
+import sys
+from concurrent.futures import (ProcessPoolExecutor, Future, wait,
+                                FIRST_COMPLETED)
+from contextlib import redirect_stdout
+from pathlib import Path
+
+from pydantic import BaseModel, Field
+from datetime import datetime
+from typing import List, Dict, Set, Optional
+
+import click
+import logging
+
+from repronim_timing import reset_ids, dump_handoff
+
+
+# Note: stages logs go to timing-dumps/*.log files, runner
+# progress goes to stdout
+
+
+class DumpStage(BaseModel):
+    name: str = Field(..., description="Stage name")
+    module: str = Field(..., description="Dump tool module name")
+    args: List[str] = Field([], description="Extra dump tool arguments")
+    output: str = Field(..., description="Output file name in "
+                                         "timing-dumps folder")
+    deps: List[str] = Field([], description="Names of stages which "
+                                            "outputs are used as input")
+    inputs: List[str] = Field([], description="Raw data files or folders "
+                                              "in session used as input")
+
+
+# common inputs for all stages except dicoms, relative to session
+# path or code folder
+CONFIG_INPUT: str = "timing-dumps-config.yaml"
+TMAP_INPUT: str = "repronim_tmap.jsonl"
+# shared code used by all dump tools, relative to code folder
+CODE_INPUTS: List[str] = ["repronim_timing.py", "repronim_dumps.py"]
+
+# timing dumps stages DAG in topological order, the same as
+# generate_timing_dumps.sh used to run
+STAGES: List[DumpStage] = [
+    DumpStage(name="dicoms", module="dump_dicoms",
+              output="dump_dicoms.jsonl",
+              inputs=["DICOMS"]),
+    DumpStage(name="qrinfo", module="dump_qrinfo",
+              output="dump_qrinfo.jsonl",
+              deps=["dicoms"],
+              inputs=["timing-reprostim-videos"]),
+    DumpStage(name="birch", module="dump_birch",
+              output="dump_birch.jsonl",
+              deps=["dicoms"],
+              inputs=["birch"]),
+    DumpStage(name="psychopy", module="dump_psychopy",
+              output="dump_psychopy.jsonl",
+              deps=["dicoms", "qrinfo"],
+              inputs=["psychopy"]),
+    DumpStage(name="reproevents", module="dump_reproevents",
+              output="dump_reproevents.jsonl",
+              deps=["dicoms"],
+              inputs=["reproevents"]),
+    DumpStage(name="marks", module="dump_marks",
+              output="dump_marks.jsonl",
+              deps=["dicoms", "qrinfo", "birch", "psychopy",
+                    "reproevents"]),
+    DumpStage(name="tmap", module="dump_tmap",
+              args=["--scans"],
+              output="dump_tmap.jsonl",
+              deps=["marks"]),
+    DumpStage(name="tmap_ex", module="dump_tmap",
+              args=["--extended", "--format", "CSV"],
+              output="dump_tmap_ex.csv",
+              deps=["marks"]),
+]
+MAP_STAGES: Dict[str, DumpStage] = {s.name: s for s in STAGES}
+
+
+# get the latest modification time of file or any file in folder,
+# 0 when path does not exist
+def get_mtime_ns(path: str) -> int:
+    if not os.path.exists(path):
+        return 0
+    res: int = os.stat(path).st_mtime_ns
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    res = max(res, os.stat(os.path.join(root, name)).st_mtime_ns)
+                except OSError:
+                    # e.g. broken symlink
+                    pass
+    return res
+
+
+# get stage output path, JSONL dumps are replaced with Parquet ones
+# for 'parquet' format
+def get_stage_output(stage: DumpStage, session_path: str,
+                     format: str = 'jsonl') -> str:
+    output: str = stage.output
+    if format == 'parquet' and output.endswith('.jsonl'):
+        output = f"{Path(output).stem}.parquet"
+    return os.path.join(session_path, "timing-dumps", output)
+
+
+# list all stage inputs: raw data, outputs of dependent stages,
+# dumps config, tmap, the dump tool itself and shared code
+def get_stage_inputs(stage: DumpStage, session_path: str,
+                     format: str = 'jsonl') -> List[str]:
+    code_path: Path = Path(__file__).parent
+    res: List[str] = [os.path.join(session_path, p) for p in stage.inputs]
+    res += [get_stage_output(MAP_STAGES[d], session_path, format)
+            for d in stage.deps]
+    res.append(str(code_path / f"{stage.module}.py"))
+    res += [str(code_path / p) for p in CODE_INPUTS]
+    if stage.deps:
+        res.append(os.path.join(session_path, CONFIG_INPUT))
+        res.append(str(code_path / TMAP_INPUT))
+    return res
+
+
+# make-style check: stage output exists and is not older than any
+# of its inputs
+def is_stage_fresh(stage: DumpStage, session_path: str,
+                   format: str = 'jsonl') -> bool:
+    out_path: str = get_stage_output(stage, session_path, format)
+    if not os.path.exists(out_path):
+        return False
+    out_mtime: int = os.stat(out_path).st_mtime_ns
+    return all(get_mtime_ns(p) <= out_mtime
+               for p in get_stage_inputs(stage, session_path, format))
+
+
+# run single dump stage in current process, stage output is written
+# to output file and all logs to the related *.log file. Written dumps
+# records are kept in memory, so dependent stages running later in
+# the same process get them without reading output files again.
+def run_stage(stage: DumpStage, session_path: str, log_level: str,
+              format: str = 'jsonl') -> int:
+    dumps_path: str = os.path.join(session_path, "timing-dumps")
+    out_path: str = get_stage_output(stage, session_path, format)
+    log_path: str = os.path.join(dumps_path,
+                                 f"{Path(stage.output).stem}.log")
+
+    # import before logs redirection, as dump tools install stderr
+    # log handler on import
+    module = importlib.import_module(stage.module)
+    stage_logger = logging.getLogger(stage.module)
+    reset_ids()
+
+    # dump is written by tool itself, so it knows the output path
+    args: List[str] = [*stage.args, "--output", out_path]
+
+    root = logging.getLogger()
+    handlers = root.handlers[:]
+    handler = logging.FileHandler(log_path, mode='w')
+    root.handlers = [handler]
+    try:
+        with open(os.devnull, 'w') as f, redirect_stdout(f), \
+                dump_handoff():
+            try:
+                code = module.main.main(
+                    args=["--log-level", log_level, *args,
+                          session_path],
+                    standalone_mode=False)
+            except Exception as e:
+                stage_logger.exception(f"Stage {stage.name} failed: {e}")
+                code = 1
+        code = code or 0
+        if code and os.path.exists(out_path):
+            # mark failed stage output as outdated
+            os.utime(out_path, ns=(0, 0))
+        stage_logger.info(f"Exit on   : {datetime.now()}")
+        stage_logger.info(f"Exit code : {code}")
+    finally:
+        root.handlers = handlers
+        handler.close()
+    return code
+
+
+# run stages respecting dependencies, independent stages are executed
+# concurrently in jobs worker processes. Up-to-date stages are skipped
+# unless force is specified, and stages depending on failed ones are
+# not executed. Returns the first non-zero stage exit code.
+def run_stages(stages: List[DumpStage], session_path: str, log_level: str,
+               jobs: int = 1, force: bool = False,
+               format: str = 'jsonl') -> int:
+    names: Set[str] = {s.name for s in stages}
+    pending: List[DumpStage] = list(stages)
+    done: Set[str] = set()
+    changed: Set[str] = set()
+    failed: Set[str] = set()
+    running: Dict[Future, DumpStage] = {}
+    res: int = 0
+
+    def on_done(stage: DumpStage, code: int):
+        nonlocal res
+        click.echo(f"{stage.module}.py exit code: {code}")
+        done.add(stage.name)
+        changed.add(stage.name)
+        if code:
+            failed.add(stage.name)
+        res = res or code
+
+    executor: Optional[ProcessPoolExecutor] = \
+        ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    try:
+        while pending or running:
+            # start all stages with completed dependencies
+            for stage in list(pending):
+                if any(d in names and d not in done for d in stage.deps):
+                    continue
+                pending.remove(stage)
+                failed_deps: List[str] = [d for d in stage.deps
+                                          if d in failed]
+                if failed_deps:
+                    click.echo(f"Skipping {stage.name} dumps, failed "
+                               f"dependencies: {', '.join(failed_deps)}")
+                    done.add(stage.name)
+                    failed.add(stage.name)
+                    res = res or 1
+                    continue
+                if not force and \
+                        not any(d in changed for d in stage.deps) and \
+                        is_stage_fresh(stage, session_path, format):
+                    click.echo(f"Skipping {stage.name} dumps, up to date")
+                    done.add(stage.name)
+                    continue
+                click.echo(f"Generating {stage.name} dumps...")
+                if executor:
+                    running[executor.submit(run_stage, stage,
+                                            session_path, log_level,
+                                            format)] = stage
+                else:
+                    on_done(stage, run_stage(stage, session_path,
+                                             log_level, format))
+            if not running:
+                continue
+            completed, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in completed:
+                stage: DumpStage = running.pop(future)
+                try:
+                    code: int = future.result()
+                except Exception as e:
+                    click.echo(f"Stage {stage.name} failed: {e}", err=True)
+                    code = 1
+                on_done(stage, code)
+    finally:
+        if executor:
+            executor.shutdown()
+    return res
+
+
+@click.command(help='Generate all timing dumps for session, independent '
+                    'stages can be executed in parallel and up-to-date '
+                    'stages are skipped.')
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--log-level', default='DEBUG',
+              type=click.Choice(['DEBUG', 'INFO',
+                                 'WARNING', 'ERROR',
+                                 'CRITICAL']),
+              help='Set the stages logging level')
+@click.option('-s', '--stage', 'stages', multiple=True,
+              type=click.Choice([s.name for s in STAGES]),
+              help='Run only specified stage(s), can be repeated')
+@click.option('-j', '--jobs', default=1, type=int,
+              help='Number of worker processes to run independent '
+                   'stages, by default all stages are executed in '
+                   'current process, which shares loaded tmap and '
+                   'dumps records between stages')
+@click.option('-f', '--force', is_flag=True,
+              help='Run stages even if their outputs are up to date')
+@click.option('--format', default='JSONL',
+              type=click.Choice(['JSONL', 'PARQUET']),
+              help='Set the dumps output format, Parquet requires '
+                   'pyarrow package')
+@click.pass_context
+def main(ctx, path: str, log_level, stages, jobs: int, force: bool,
+         format: str):
+    click.echo(f"Generating timing dumps for session: {path}")
+    click.echo(f"Started on    : {datetime.now()}, {getpass.getuser()}@{os.uname().nodename}")
+
+    dumps_path: str = os.path.join(path, "timing-dumps")
+    click.echo(f"Timing dumps will be saved to: {dumps_path}")
+    if not os.path.exists(dumps_path):
+        os.makedirs(dumps_path)
+        click.echo(f"Created directory: {dumps_path}")
+
+    return run_stages([s for s in STAGES if not stages or s.name in stages],
+                      path, log_level, jobs, force, format.lower())
+
+
+if __name__ == "__main__":
+    code = main(standalone_mode=False)
+    sys.exit(code)
@@ -0,0 +1,295 @@
+import itertools
+import logging
+import sys
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
+
+import numpy as np
+import yaml
+
+# dump tools import repronim_timing as top level module
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+from dump_marks import (align_series, find_swimlane_series, Clock,
+                        EventData, SeriesData, SeriesIndex, SwimlaneModel,
+                        DumpModel, TrainAlignment, xcorr_align_events,
+                        xcorr_model_series, get_tmap_svc)
+from dump_tmap import generate_tmap
+from repronim_dumps import DumpsConfig
+from repronim_timing import TMapService, TMapRecord, jsonl_output
+import pytest
+
+logger = logging.getLogger(__name__)
+
+
+# best order-preserving one-to-one alignment by brute force, as
+# (matched pairs count, total score)
+def brute_force_alignment(match: np.ndarray, score: np.ndarray):
+    n, m = match.shape
+    best = (0, 0.0)
+    for k in range(1, min(n, m) + 1):
+        for rows in itertools.combinations(range(n), k):
+            for cols in itertools.combinations(range(m), k):
+                if all(match[i, j] for i, j in zip(rows, cols)):
+                    total: float = sum(score[i, j] for i, j in zip(rows, cols))
+                    if k > best[0] or (k == best[0] and total < best[1]):
+                        best = (k, total)
+    return best
+
+
+def test_align_series():
+    logger.info(f"Testing align_series")
+    # more matched pairs win over better score of the single pair
+    match = np.array([[True, True],
+                      [False, True]])
+    score = np.array([[1.0, 0.5],
+                      [0.0, 1.0]])
+    assert align_series(match, score) == [0, 1]
+
+    # the same number of pairs, the smaller total score wins
+    match = np.array([[True, True]])
+    score = np.array([[5.0, 1.0]])
+    assert align_series(match, score) == [1]
+
+    # crossing pairs are not allowed, as time order is kept
+    match = np.array([[False, True],
+                      [True, False]])
+    score = np.array([[0.0, 2.0],
+                      [1.0, 0.0]])
+    assert align_series(match, score) == [-1, 0]
+
+    # no matches at all
+    assert align_series(np.zeros((2, 3), dtype=bool),
+                        np.zeros((2, 3))) == [-1, -1]
+    assert align_series(np.zeros((0, 3), dtype=bool),
+                        np.zeros((0, 3))) == []
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_align_series_optimal(seed: int):
+    rng = np.random.default_rng(seed)
+    n, m = rng.integers(1, 6, size=2)
+    match: np.ndarray = rng.random((n, m)) < 0.5
+    score: np.ndarray = rng.random((n, m)).round(2)
+    res: List[int] = align_series(match, score)
+
+    # one-to-one, time ordered and only matched pairs
+    pairs = [(i, j) for i, j in enumerate(res) if j >= 0]
+    assert all(match[i, j] for i, j in pairs)
+    cols = [j for _, j in pairs]
+    assert cols == sorted(set(cols))
+
+    count, total = brute_force_alignment(match, score)
+    assert len(pairs) == count
+    assert sum(score[i, j] for i, j in pairs) == pytest.approx(total)
+
+
+def test_series_index():
+    logger.info(f"Testing SeriesIndex")
+    t0: datetime = datetime(2024, 6, 4, 13, 0, 0)
+    # series are not sorted by synced start
+    offsets: List[float] = [100.0, 0.0, 50.0, 103.5, 50.0]
+    series: List[SeriesData] = [
+        SeriesData(name=f"series-{i}",
+                   synced_isotime_start=t0 + timedelta(seconds=v))
+        for i, v in enumerate(offsets)]
+    index: SeriesIndex = SeriesIndex(series)
+
+    # window is padded by 1 sec and bounds are inclusive, indexes are
+    # returned in the series order
+    assert list(index.find(t0 + timedelta(seconds=101), 2.0)) == [0, 3]
+    assert list(index.find(t0 + timedelta(seconds=101), 1.0)) == [0]
+    assert list(index.find(t0 + timedelta(seconds=50), 0.0)) == [2, 4]
+    assert list(index.find(t0 + timedelta(seconds=48.5), 0.5)) == [2, 4]
+    assert list(index.find(t0 + timedelta(seconds=48.5), 0.4)) == []
+    assert list(index.find(t0 - timedelta(seconds=10), 2.0)) == []
+    assert list(index.find(t0, 120.0)) == [0, 1, 2, 3, 4]
+    assert list(index.find(None, 2.0)) == []
+    assert [sd.name for sd in index.find_series(t0, 2.0)] == ["series-1"]
+
+    # the same as checking all series
+    for v in np.arange(-5.0, 110.0, 0.5):
+        dt: datetime = t0 + timedelta(seconds=float(v))
+        expected: List[int] = [
+            i for i, sd in enumerate(series)
+            if abs((sd.synced_isotime_start - dt).total_seconds()) <= 3.0]
+        assert list(index.find(dt, 2.0)) == expected
+
+    assert list(SeriesIndex([]).find(t0, 2.0)) == []
+
+
+# runs of events within interval tolerance found one by one, the run
+# ends with the first event out of tolerance, as ids lists
+def find_runs(events: List[EventData], interval: float) -> List[List[str]]:
+    runs: List[List[str]] = []
+    run: List[str] = []
+    for evt in events:
+        run.append(evt.id)
+        if not (interval * 0.8 <= evt.duration <= interval * 1.2):
+            if len(run) > 5:
+                runs.append(run)
+            run = []
+    return runs
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 7, 16, 65536])
+def test_find_swimlane_series(chunk_size: int):
+    logger.info(f"Testing find_swimlane_series with chunk_size="
+                f"{chunk_size}")
+    rng = np.random.default_rng(chunk_size)
+    interval: float = 2.0
+    # pulse trains of different length separated by gaps, with
+    # single out of tolerance events inside, and trailing run
+    durations: List[float] = []
+    for n in [8, 3, 20, 6, 5, 12, 1, 30]:
+        durations += list(interval + rng.uniform(-0.3, 0.3, n - 1))
+        durations.append(interval * rng.choice([0.5, 3.0, 10.0]))
+    durations += [interval] * 9
+    t0: datetime = datetime(2024, 6, 4, 13, 0, 0)
+    events: List[EventData] = []
+    t: datetime = t0
+    for i, d in enumerate(durations):
+        events.append(EventData(id=f"birch-{i:06d}", isotime=t,
+                                duration=float(d)))
+        t += timedelta(seconds=float(d))
+    swimlane: SwimlaneModel = SwimlaneModel(name="birch", clock=Clock.BIRCH,
+                                            events=events)
+
+    lst: List[SeriesData] = find_swimlane_series(swimlane, interval,
+                                                 chunk_size=chunk_size)
+    expected: List[List[str]] = find_runs(events, interval)
+    assert [len(run) for run in expected] == [8, 20, 6, 12, 30]
+    assert [[evt.id for evt in sd.events] for sd in lst] == expected
+    assert [sd.name for sd in lst] == [f"birch-series-{i}"
+                                       for i in range(1, 6)]
+    assert lst[0].isotime_start == t0
+    assert lst[0].count == 8
+    assert lst[1].next_series_interval == \
+        (lst[2].isotime_start - lst[1].isotime_start).total_seconds()
+    assert lst[-1].next_series_interval == 0
+
+    # events can be streamed instead of stored in swimlane
+    lst2: List[SeriesData] = find_swimlane_series(
+        SwimlaneModel(name="birch", clock=Clock.BIRCH), interval,
+        iter(events), chunk_size=chunk_size)
+    assert [[evt.id for evt in sd.events] for sd in lst2] == expected
+
+
+def test_xcorr_align_events():
+    logger.info(f"Testing xcorr_align_events")
+    rng = np.random.default_rng(0)
+    ref_times: np.ndarray = 1.7e9 + 2.0 * np.arange(30)
+    # shifted by 3.3 sec with jitter, dropped and extra pulses
+    times: np.ndarray = ref_times + 3.3 + rng.uniform(-0.02, 0.02, 30)
+    dropped: List[int] = [0, 7, 8, 21]
+    keep: np.ndarray = np.setdiff1d(np.arange(30), dropped)
+    extra: np.ndarray = ref_times[[3, 10, 11, 25, 28, 29]] + 3.3 + 1.0
+    times = np.concatenate([times[keep], extra])
+    # shuffled events order
+    order: np.ndarray = rng.permutation(len(times))
+    times = times[order]
+
+    res: TrainAlignment = xcorr_align_events(ref_times, times, 5.0, 0.5)
+    assert res.offset == pytest.approx(3.3, abs=0.02)
+    assert res.confidence == pytest.approx(26 / 30)
+    pos: dict = {int(k): j for j, k in enumerate(order)}
+    assert res.pairs == [(int(i), pos[k]) for k, i in enumerate(keep)]
+
+    assert xcorr_align_events(ref_times, np.empty(0), 5.0, 0.5).offset is None
+    assert xcorr_align_events(np.empty(0), times, 5.0, 0.5).pairs == []
+
+
+def test_xcorr_model_series():
+    logger.info(f"Testing xcorr_model_series")
+    rng = np.random.default_rng(1)
+    t0: datetime = datetime(2024, 6, 4, 13, 0, 0)
+    model: DumpModel = DumpModel(
+        session_id="ses-20240604",
+        dicoms=SwimlaneModel(name="dicoms", clock=Clock.DICOMS),
+        birch=SwimlaneModel(name="birch", clock=Clock.BIRCH))
+    # 4 DICOMs func series of 15 volumes 2 sec interval, 70 sec apart
+    for k in range(4):
+        start: datetime = t0 + timedelta(seconds=70 * k)
+        events: List[EventData] = [
+            EventData(id=f"dicoms-{k}-{i:02d}",
+                      isotime=start + timedelta(seconds=2.0 * i))
+            for i in range(15)]
+        model.dicoms.series.append(SeriesData(
+            name=f"func-{k}", events=events, count=len(events),
+            interval=2.0, swimlane=model.dicoms))
+
+    # birch pulses 0.3 sec later in global clock, with dropped pulses,
+    # extra pulses and pulses of the series not acquired by DICOMs,
+    # the last series pulses are 19.3 sec earlier, e.g. DICOMs clock
+    # offset changed
+    svc = get_tmap_svc()
+    shifts: List[float] = [0.3, 0.3, 0.3, -19.3]
+    expected: List[List[str]] = []
+    birch_times: List[tuple] = []
+    for k, sd in enumerate(model.dicoms.series):
+        ids: List[str] = []
+        for i, evt in enumerate(sd.events):
+            if (k, i) in [(0, 0), (1, 5), (1, 6), (2, 14)]:
+                ids.append(None)
+                continue
+            synced: datetime = svc.convert(Clock.DICOMS, Clock.ISOTIME,
+                                           evt.isotime)
+            birch_times.append((synced + timedelta(seconds=shifts[k] + rng.uniform(
+                -0.02, 0.02)), f"birch-{k}-{i:02d}"))
+            ids.append(f"birch-{k}-{i:02d}")
+        expected.append(ids)
+    birch_times += [(t0 + timedelta(seconds=v), f"birch-extra-{v}")
+                    for v in [7.1, 81.3, 150.9]]
+    birch_times += [(t0 + timedelta(seconds=330 + 2.0 * i), f"birch-other-{i}")
+                    for i in range(15)]
+    for synced, uid in sorted(birch_times):
+        model.birch.events.append(EventData(
+            id=uid, isotime=svc.convert(Clock.ISOTIME, Clock.BIRCH, synced)))
+
+    res: List[dict] = xcorr_model_series(DumpsConfig(), model)
+    assert len(res) == 4
+    for k, ids in enumerate(expected):
+        sd: SeriesData = res[k]["birch"]
+        assert [evt.id if evt else None for evt in sd.events] == ids
+        assert sd.count == sum(1 for uid in ids if uid)
+        assert sd.confidence == pytest.approx(sd.count / 15)
+        assert sd.offset == pytest.approx(shifts[k], abs=0.02)
+        assert set(res[k]) == {"birch"}
+
+
+def test_tmap_scans_drift(tmp_path: Path):
+    logger.info(f"Testing drift model fitted with per-scan tmap marks")
+    session: Path = Path(__file__).parent.parent.parent / "ses-20240830"
+    with open(session / "timing-dumps-config.yaml") as f:
+        cfg: DumpsConfig = DumpsConfig(**yaml.safe_load(f))
+    path_tmap: str = str(tmp_path / "dump_tmap.jsonl")
+    with jsonl_output(path_tmap):
+        assert generate_tmap(cfg, "ses-20240830",
+                             str(session / "timing-dumps" / "dump_marks.jsonl"),
+                             False, 'jsonl', path_tmap, True) == 0
+    svc: TMapService = TMapService(path_tmap)
+    marks: List[TMapRecord] = list(svc.marks)
+    assert len(marks) == 247
+
+    # DICOMs offsets jump between func series, so each series is
+    # segment, and only the long one has enough span to fit drift
+    segments = svc.segments[Clock.DICOMS]
+    assert [sg.count for sg in segments] == [16, 151, 16, 16, 16, 16, 16]
+    sg = segments[1]
+    assert 1e-6 < abs(sg.deviation - 1.0) < 2e-5
+    assert sg.residual < 0.01
+    assert all(x.deviation == 1.0 for i, x in enumerate(segments) if i != 1)
+
+    # fitted series follows scan marks within their jitter, while short
+    # series keep recorded offsets
+    for m in marks:
+        dt: datetime = svc.convert(Clock.ISOTIME, Clock.DICOMS, m.isotime)
+        d: float = abs((dt - m.dicoms_isotime).total_seconds())
+        if sg.isotime_start <= m.isotime <= sg.isotime_end:
+            assert d < 0.04
+        else:
+            assert d < 1e-6
+
+    # psychopy is fitted as a whole session
+    assert [sg.count for sg in svc.segments[Clock.PSYCHOPY]] == [247]
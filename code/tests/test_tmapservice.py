@@ -1,12 +1,27 @@
+import io
+import json
 import logging
 import os
-from datetime import datetime
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List
 
-from code.repronim_timing import (TMapRecord, Clock,
+import numpy as np
+import pandas as pd
+
+from code.repronim_timing import (TMapRecord, Clock, bisect_isotime,
+                                  build_time_index, save_time_index,
+                                  load_time_index, seek_isotime,
+                                  dump_jsonl, jsonl_output, dump_handoff,
+                                  get_dump_records, get_dump_file,
+                                  read_dump_frame, JsonlReader,
+                                  find_study_range, get_study_summary_path,
                                   get_tmap_offset,
                                   get_tmap_deviation,
+                                  get_tmap_isotime,
                                   TMapService,
-                                  parse_isotime, str_isotime)
+                                  parse_isotime, parse_isotimes, parse_jsonl, str_isotime,
+                                  to_datetime64)
 import pytest
 
 logger = logging.getLogger(__name__)
@@ -86,3 +101,449 @@ def test_tmap_svc_convert(tmap_svc: TMapService,
     assert to_isotime_str == to_dt
 
 
+def _find_tmap_linear(tmap_svc: TMapService, clock: Clock,
+                      dt: datetime) -> TMapRecord:
+    last_mark = tmap_svc.marks[0]
+    for mark in tmap_svc.marks:
+        if get_tmap_isotime(clock, mark) > dt:
+            break
+        last_mark = mark
+    return last_mark
+
+
+@pytest.mark.parametrize("clock", [Clock.ISOTIME, Clock.BIRCH,
+                                   Clock.DICOMS, Clock.PSYCHOPY,
+                                   Clock.QRINFO, Clock.REPROSTIM_VIDEO])
+def test_tmap_svc_find_tmap(clock: Clock):
+    logger.info(f"Testing TMapService.find_tmap")
+    path_tmap: str = str(Path(__file__).parent.parent / "repronim_tmap.jsonl")
+    svc: TMapService = TMapService(path_tmap)
+    assert len(svc.marks) > 1
+    for mark in svc.marks:
+        t: datetime = get_tmap_isotime(clock, mark)
+        for dt in [t - timedelta(days=1), t - timedelta(microseconds=1),
+                   t, t + timedelta(seconds=1), t + timedelta(days=1)]:
+            assert svc.find_tmap(clock, dt) == _find_tmap_linear(svc, clock, dt)
+
+
+@pytest.mark.parametrize("from_clock", [Clock.ISOTIME, Clock.BIRCH,
+                                        Clock.DICOMS, Clock.PSYCHOPY,
+                                        Clock.QRINFO])
+@pytest.mark.parametrize("to_clock", [Clock.ISOTIME, Clock.BIRCH,
+                                      Clock.DICOMS, Clock.PSYCHOPY,
+                                      Clock.QRINFO])
+@pytest.mark.parametrize("dicoms_offset", [None, -26.78])
+def test_tmap_svc_convert_many(from_clock: Clock, to_clock: Clock,
+                               dicoms_offset: float):
+    logger.info(f"Testing TMapService.convert_many")
+    path_tmap: str = str(Path(__file__).parent.parent / "repronim_tmap.jsonl")
+    svc: TMapService = TMapService(path_tmap)
+    svc.force_offset(Clock.DICOMS.value, dicoms_offset)
+    lst: List[datetime] = []
+    for mark in svc.marks:
+        t: datetime = pd.Timestamp(get_tmap_isotime(from_clock, mark))
+        lst += [t - pd.Timedelta(seconds=90.5), t,
+                t + pd.Timedelta(seconds=37.1234567), t + pd.Timedelta(hours=2)]
+
+    expected = [to_datetime64(svc.convert(from_clock, to_clock, dt))
+                for dt in lst]
+    res = svc.convert_many(from_clock, to_clock,
+                           pd.DatetimeIndex(lst).to_numpy())
+    assert list(res) == expected
+
+    ser = pd.Series(lst, index=range(10, 10 + len(lst)), name="isotime")
+    res_ser = svc.convert_many(from_clock, to_clock, ser)
+    assert isinstance(res_ser, pd.Series)
+    assert list(res_ser.index) == list(ser.index)
+    assert list(res_ser.to_numpy()) == expected
+
+
+def test_tmap_svc_tables():
+    logger.info(f"Testing TMapService.build_tables")
+    path_tmap: str = str(Path(__file__).parent.parent / "repronim_tmap.jsonl")
+    svc: TMapService = TMapService(path_tmap)
+    j: int = svc._clock_index[Clock.DICOMS]
+    assert svc._tmap_offsets.shape == (len(svc.marks), len(Clock))
+    for i, mark in enumerate(svc.marks):
+        assert svc._tmap_offsets[i, j] == get_tmap_offset(Clock.DICOMS, mark)
+        assert svc._tmap_isotimes[i, j] == to_datetime64(mark.dicoms_isotime)
+    # DICOMs marks offsets jitter too much to fit drift, so DICOMs
+    # periods deviation is used instead
+    assert Clock.DICOMS not in svc._fits
+    assert all(sg.deviation == 1.0 for sg in svc.segments[Clock.DICOMS])
+    assert svc._adjust_clocks[j]
+
+    # forced offset is compiled into tables and disables correction
+    svc.force_offset(Clock.DICOMS.value, -26.78)
+    assert (svc._tmap_offsets[:, j] == -26.78).all()
+    assert not svc._adjust_clocks[j]
+
+    svc.force_offset(Clock.DICOMS.value, None)
+    assert svc._tmap_offsets[0, j] == get_tmap_offset(Clock.DICOMS,
+                                                      svc.marks[0])
+    assert svc._adjust_clocks[j]
+
+    # the same for fitted clock
+    k: int = svc._clock_index[Clock.PSYCHOPY]
+    assert Clock.PSYCHOPY in svc._fits
+    svc.force_offset(Clock.PSYCHOPY.value, -26.78)
+    assert not svc._adjust_clocks[k]
+    svc.force_offset(Clock.PSYCHOPY.value, None)
+    assert svc._adjust_clocks[k]
+
+
+def test_tmap_svc_convert_dicoms():
+    logger.info(f"Testing TMapService.convert DICOMs with periods deviation")
+    path_tmap: str = str(Path(__file__).parent.parent / "repronim_tmap.jsonl")
+    svc: TMapService = TMapService(path_tmap)
+    marks: List[TMapRecord] = list(svc.marks)
+    # valid period is interpolated between DICOMs times of its marks
+    for i in [2, 5, 8]:
+        m0, m1 = marks[i], marks[i + 1]
+        duration: float = (m1.isotime - m0.isotime).total_seconds()
+        deviation: float = (m1.dicoms_isotime -
+                            m0.dicoms_isotime).total_seconds() / duration
+        for d in [0.0, 0.3 * duration, 0.9 * duration]:
+            dt: datetime = m0.isotime + timedelta(seconds=d)
+            expected: datetime = m0.dicoms_isotime + \
+                timedelta(seconds=d * deviation)
+            res: datetime = svc.convert(Clock.ISOTIME, Clock.DICOMS, dt)
+            assert abs(res - expected) < timedelta(microseconds=2)
+            assert abs(svc.convert(Clock.DICOMS, Clock.ISOTIME, res) -
+                       dt) < timedelta(microseconds=2)
+
+    # period over DICOMs clock correction uses average deviation
+    i: int = 4
+    assert not svc.get_period(i).dicoms_valid
+    dt: datetime = marks[i].isotime + timedelta(seconds=60)
+    expected: datetime = marks[i].dicoms_isotime + \
+        timedelta(seconds=60 * svc.avg_period.dicoms_deviation)
+    assert abs(svc.convert(Clock.ISOTIME, Clock.DICOMS, dt) -
+               expected) < timedelta(microseconds=2)
+
+
+def test_tmap_svc_records(path_tmap_jsonl: str):
+    logger.info(f"Testing TMapService columnar records")
+    objs: List[dict] = parse_jsonl(path_tmap_jsonl)
+    svc: TMapService = TMapService(objs)
+    assert svc.marks.df['session_id'].dtype == 'category'
+    assert list(svc.marks) == [TMapRecord(**obj) for obj in objs]
+    assert svc.marks[-1] == TMapRecord(**objs[-1])
+    assert svc.marks.column('reproevents_isotime') == [None, None]
+
+    # periods are indexed by position of the starting mark
+    assert len(svc.periods) == len(svc.marks)
+    assert svc.get_period(0).key == "ses-20240604|mark_000018"
+    assert svc.get_period(1) is None
+
+
+def test_tmap_svc_whole_second_isotime():
+    logger.info(f"Testing TMapService marks with whole second isotime")
+    # pydantic dumps datetime without fraction when microseconds are 0
+    objs: List[dict] = [
+        {"session_id": "ses-1", "mark_id": "mark_1",
+         "isotime": "2024-06-04T13:05:01.500000",
+         "dicoms_isotime": "2024-06-04T13:05:01.500000",
+         "reprostim_video_isotime": "2024-06-04T13:05:01",
+         "reprostim_video_offset": -0.5},
+        {"session_id": "ses-1", "mark_id": "mark_2",
+         "isotime": "2024-06-04T13:06:01.500000",
+         "dicoms_isotime": "2024-06-04T13:06:01.500000",
+         "reprostim_video_isotime": "2024-06-04T13:06:01.250000",
+         "reprostim_video_offset": -0.25},
+    ]
+    svc: TMapService = TMapService(objs)
+    assert list(svc.marks) == [TMapRecord(**obj) for obj in objs]
+    assert svc.marks[0].reprostim_video_isotime == datetime(2024, 6, 4,
+                                                            13, 5, 1)
+
+
+def test_tmap_svc_fit_segments():
+    logger.info(f"Testing TMapService.fit_segments")
+    # DICOMs clock drifts 20 ppm with timestamps jitter and 0.5 sec
+    # step in the middle of session
+    t0 = datetime(2024, 6, 4, 13, 0, 0)
+    marks: List[TMapRecord] = []
+    for i in range(200):
+        t: float = i * 4.0
+        offset: float = 100.0 + 20e-6 * t + (0.005 if i % 2 else -0.005) + \
+            (0.5 if i >= 100 else 0.0)
+        marks.append(TMapRecord(isotime=t0 + timedelta(seconds=t),
+                                session_id="ses-20240604",
+                                mark_id=f"mark_{i:06d}",
+                                birch_isotime=t0 + timedelta(seconds=t),
+                                dicoms_isotime=t0 + timedelta(seconds=t + offset),
+                                dicoms_offset=offset))
+    # trailing short segment after another step keeps recorded offsets
+    for i in range(200, 203):
+        t: float = i * 4.0
+        offset: float = 101.0 + (0.005 if i % 2 else -0.005)
+        marks.append(TMapRecord(isotime=t0 + timedelta(seconds=t),
+                                session_id="ses-20240604",
+                                mark_id=f"mark_{i:06d}",
+                                birch_isotime=t0 + timedelta(seconds=t),
+                                dicoms_isotime=t0 + timedelta(seconds=t + offset),
+                                dicoms_offset=offset))
+    svc: TMapService = TMapService(marks)
+    segments = svc.segments[Clock.DICOMS]
+    assert [sg.count for sg in segments] == [100, 100, 3]
+    assert segments[2].deviation == 1.0
+    assert segments[2].residual == 0.0
+    for i in range(200, 203):
+        dt: datetime = svc.convert(Clock.ISOTIME, Clock.DICOMS,
+                                   marks[i].isotime)
+        assert dt == marks[i].dicoms_isotime
+    segments = segments[:2]
+    for sg in segments:
+        assert abs(sg.deviation - 1.00002) < 1e-6
+        assert sg.residual == pytest.approx(0.005, abs=1e-4)
+    assert segments[1].isotime_start == t0 + timedelta(seconds=400)
+
+    # conversion evaluates fitted model rather than jittered marks
+    for i in [10, 11, 150]:
+        t: float = i * 4.0 + 1.0
+        expected: float = 100.0 + 20e-6 * t + (0.5 if i >= 100 else 0.0)
+        dt: datetime = svc.convert(Clock.ISOTIME, Clock.DICOMS,
+                                   t0 + timedelta(seconds=t))
+        assert abs((dt - t0).total_seconds() - t - expected) < 1e-3
+        assert abs(svc.convert(Clock.DICOMS, Clock.ISOTIME, dt) -
+                   (t0 + timedelta(seconds=t))) < timedelta(microseconds=1)
+
+
+@pytest.mark.parametrize("v, tz_convert", [
+    ("2024-06-04T13:54:19.703000", True),
+    ("2024-06-04T13:54:19-04:00", True),
+    ("2024-06-04T17:54:19.7031Z", True),
+    ("2024-06-04T13:54:19.703000-05:00", False),
+    ("2024-06-04T13:54:19.703000123-04:00", True),
+    ("2024-11-03T01:30:00-05:00", True),
+])
+def test_parse_isotime(v: str, tz_convert: bool):
+    logger.info(f"Testing parse_isotime({v}, {tz_convert})")
+    ts = pd.to_datetime(v)
+    if ts.tzinfo is not None:
+        if tz_convert:
+            ts = ts.tz_convert('America/New_York')
+        ts = ts.tz_localize(None)
+    res = parse_isotime(v, tz_convert)
+    assert res == ts
+    assert res.unit == ts.unit
+    assert list(parse_isotimes([v, v], tz_convert)) == [ts, ts]
+    assert parse_isotime("") is None
+
+
+@pytest.mark.parametrize("side", ['left', 'right'])
+def test_bisect_isotime(side: str):
+    logger.info(f"Testing bisect_isotime side={side}")
+    t0 = datetime(2024, 6, 4, 13, 0, 0)
+    lines: List[bytes] = [b"# comment\n"]
+    for i in range(5000):
+        # repeat timestamps to check both sides
+        lines.append(f"{(t0 + timedelta(seconds=i // 2)).isoformat()},"
+                     f"{i}\n".encode())
+    data: bytes = b"".join(lines)
+    offsets = np.cumsum([0] + [len(line) for line in lines])
+
+    def get_time(line: bytes):
+        try:
+            return parse_isotime(line.decode().split(',')[0])
+        except ValueError:
+            return None
+
+    f = io.BytesIO(data)
+    for sec in [-1, 0, 1, 777, 2499, 2500]:
+        dt = t0 + timedelta(seconds=sec)
+        # expected first line index after the target time
+        i = 1 + min(max(2 * sec + (2 if side == 'right' else 0), 0), 5000)
+        assert bisect_isotime(f, dt, get_time, side) == offsets[i]
+
+
+def test_time_index(tmp_path: Path):
+    logger.info(f"Testing sidecar time index")
+    t0 = datetime(2024, 6, 4, 13, 0, 0)
+    path: Path = tmp_path / "events.csv"
+    path.write_bytes(b"isotime,i\n" + b"".join(
+        f"{(t0 + timedelta(seconds=i // 3)).isoformat()},{i}\n".encode()
+        for i in range(3000)))
+
+    def get_time(line: bytes):
+        try:
+            return parse_isotime(line.decode().split(',')[0])
+        except ValueError:
+            return None
+
+    assert load_time_index(str(path)) is None
+    save_time_index(str(path), build_time_index(str(path), get_time, 100))
+    index = load_time_index(str(path))
+    # header line has no timestamp, so the next line is indexed instead
+    assert len(index.offsets) == 31 and index.offsets[0] == 10
+    with open(path, 'rb') as f:
+        for sec in [-1, 0, 1, 333, 999, 1000]:
+            dt = t0 + timedelta(seconds=sec)
+            for side in ['left', 'right']:
+                assert seek_isotime(f, dt, get_time, side, index=index) == \
+                       bisect_isotime(f, dt, get_time, side)
+
+    # index is invalidated when log file is changed
+    with open(path, 'ab') as f:
+        f.write(b"2024-06-04T14:00:00,3000\n")
+    assert load_time_index(str(path)) is None
+
+
+def test_jsonl_output(tmp_path: Path, capsys):
+    logger.info(f"Testing buffered JSONL output")
+    objs = [TMapRecord(session_id="ses-20240604", id=f"mark-{i:06d}",
+                       isotime=datetime(2024, 6, 4, 13, 0, i))
+            for i in range(10)]
+    objs += [{"id": "birch-000001", "description": "Ünicode ✓"}, {}, None]
+
+    # unbuffered stdout output
+    for obj in objs:
+        dump_jsonl(obj)
+    expected: str = capsys.readouterr().out
+    assert expected.count("\n") == 11
+
+    path: Path = tmp_path / "dump.jsonl"
+    with jsonl_output(str(path)) as sink:
+        sink.batch_size = 3
+        for obj in objs:
+            dump_jsonl(obj)
+    assert path.read_text(encoding='utf-8') == expected
+    assert capsys.readouterr().out == ""
+
+    with jsonl_output():
+        for obj in objs:
+            dump_jsonl(obj)
+    assert capsys.readouterr().out == expected
+
+
+def test_dump_handoff(tmp_path: Path):
+    logger.info(f"Testing in-memory dumps handoff")
+    objs = [TMapRecord(session_id="ses-20240604", mark_id=f"mark-{i:06d}",
+                       isotime=datetime(2024, 6, 4, 13, 0, i, i * 1000))
+            for i in range(5)]
+    objs += [{"type": "BirchRecord", "id": "birch-000001", "data": [1, 2]}]
+    path: Path = tmp_path / "dump.jsonl"
+    with dump_handoff(), jsonl_output(str(path)):
+        for obj in objs:
+            dump_jsonl(obj)
+    # records are not changed when objects are changed after writing
+    objs[0].mark_id = "mark-changed"
+    objs[-1]["data"].append(3)
+
+    expected: List[dict] = [json.loads(line) for line in
+                            path.read_text(encoding='utf-8').splitlines()]
+    records = get_dump_records(str(path))
+    assert records == expected
+    assert parse_jsonl(str(path)) == expected
+    assert parse_jsonl(str(path), types=["BirchRecord"],
+                       fields=["id"]) == [{"id": "birch-000001"}]
+
+    # records are ignored once the file is changed
+    path.write_text(path.read_text(encoding='utf-8').replace(
+        "mark-000001", "mark-000042"), encoding='utf-8')
+    assert get_dump_records(str(path)) is None
+    assert parse_jsonl(str(path))[1]["mark_id"] == "mark-000042"
+
+    # records are not kept outside of handoff block
+    path2: Path = tmp_path / "dump2.jsonl"
+    with jsonl_output(str(path2)):
+        dump_jsonl(objs[0])
+    assert get_dump_records(str(path2)) is None
+
+
+def test_parquet_output(tmp_path: Path):
+    pytest.importorskip("pyarrow")
+    logger.info(f"Testing Parquet output")
+    objs = [TMapRecord(session_id="ses-20240604", mark_id=f"mark-{i:06d}",
+                       isotime=datetime(2024, 6, 4, 13, 0, i, 250),
+                       duration=i * 0.5)
+            for i in range(5)]
+    objs += [{"id": "qrinfo-000001", "data": {"logfn": "a.log", "n": 1}},
+             {"id": "qrinfo-000002", "value": "x"},
+             {"id": "qrinfo-000003", "value": 3}]
+
+    path_jsonl: Path = tmp_path / "dump.jsonl"
+    path_parquet: Path = tmp_path / "dump.parquet"
+    for path in (path_jsonl, path_parquet):
+        with jsonl_output(str(path)):
+            for obj in objs:
+                dump_jsonl(obj)
+
+    # the same records, except omitted null values
+    expected: List = [{k: v for k, v in obj.items() if v is not None}
+                      for obj in parse_jsonl(str(path_jsonl))]
+    assert parse_jsonl(str(path_parquet)) == expected
+
+    df: pd.DataFrame = read_dump_frame(str(path_parquet))
+    assert len(df) == 8
+    assert pd.api.types.is_datetime64_any_dtype(df['isotime'])
+    assert df['isotime'][1] == pd.Timestamp("2024-06-04T13:00:01.000250")
+
+    # the most recently written dump is used when both exist
+    os.utime(path_jsonl, ns=(0, 10 ** 18))
+    os.utime(path_parquet, ns=(0, 2 * 10 ** 18))
+    assert get_dump_file(str(tmp_path), "dump") == str(path_parquet)
+    os.utime(path_jsonl, ns=(0, 3 * 10 ** 18))
+    assert get_dump_file(str(tmp_path), "dump") == str(path_jsonl)
+    path_jsonl.unlink()
+    assert get_dump_file(str(tmp_path), "dump") == str(path_parquet)
+
+
+def test_jsonl_reader(tmp_path: Path):
+    logger.info(f"Testing memory-mapped JSONL reader")
+    path: Path = tmp_path / "dump.jsonl"
+    path.write_bytes(b'{"type": "StudyRecord", "id": "study-000001"}\r\n'
+                     b'\n'
+                     b'{"id": "series-000001", "type": "SeriesRecord"}\n'
+                     b'{"type":"DicomsRecord","id":"dicoms-000001",'
+                     b'"data":{"type":"StudyRecord"}}')
+    with JsonlReader(str(path)) as reader:
+        assert len(reader) == 3
+        assert reader[-1]["id"] == "dicoms-000001"
+        assert [obj["id"] for obj in reader] == \
+               ["study-000001", "series-000001", "dicoms-000001"]
+        assert list(reader.iter(types=["SeriesRecord", "DicomsRecord"],
+                                fields=["id"])) == \
+               [{"id": "series-000001"}, {"id": "dicoms-000001"}]
+        with pytest.raises(IndexError):
+            reader[3]
+
+    path.write_bytes(b'')
+    assert parse_jsonl(str(path)) == []
+
+
+def test_find_study_range(tmp_path: Path):
+    logger.info(f"Testing study range lookup")
+    path: Path = tmp_path / "dump_dicoms.jsonl"
+    path.write_text('{"type": "DicomsRecord", "id": "dicoms-000001"}\n'
+                    '{"type": "StudyRecord", "name": "dbic^QA", '
+                    '"range_isotime_start": "2024-06-04T13:50:00", '
+                    '"range_isotime_end": "2024-06-04T14:05:00"}\n')
+    expected = (pd.Timestamp("2024-06-04T13:50:00"),
+                pd.Timestamp("2024-06-04T14:05:00"))
+    # old dump without summary
+    assert find_study_range(str(path)) == expected
+
+    # summary is used only when its stamp matches the dump size and mtime
+    summary_path: str = get_study_summary_path(str(path))
+    assert summary_path == str(tmp_path / "dump_dicoms_studies.jsonl")
+    st = os.stat(path)
+    study: str = ('{"type": "StudyRecord", "name": "dbic^QA", '
+                  '"range_isotime_start": "2024-06-04T13:51:00", '
+                  '"range_isotime_end": "2024-06-04T14:06:00"}\n')
+    with open(summary_path, 'w') as f:
+        f.write(study)
+    assert find_study_range(str(path)) == expected
+    with open(summary_path, 'w') as f:
+        f.write(f'{{"type": "DumpStampRecord", "size": {st.st_size}, '
+                f'"mtime_ns": {st.st_mtime_ns - 1}}}\n' + study)
+    assert find_study_range(str(path)) == expected
+    with open(summary_path, 'w') as f:
+        f.write(f'{{"type": "DumpStampRecord", "size": {st.st_size}, '
+                f'"mtime_ns": {st.st_mtime_ns}}}\n' + study)
+    # summary written before the dump is still used while stamp matches
+    os.utime(summary_path, ns=(st.st_mtime_ns, st.st_mtime_ns - 10))
+    assert find_study_range(str(path)) == \
+           (pd.Timestamp("2024-06-04T13:51:00"),
+            pd.Timestamp("2024-06-04T14:06:00"))